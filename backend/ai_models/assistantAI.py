@@ -7,6 +7,12 @@ OpenRouter sẽ hỗ trợ và AiESP sẽ học từ đó
 import json
 import sys
 import os
+import argparse
+import select
+import threading
+import time
+import math
+import traceback
 from typing import Dict, Any, List, Tuple
 from datetime import datetime
 import re
@@ -20,6 +26,13 @@ except ImportError:
     HAS_PSYCOPG2 = False
     print("[AiESP] Warning: psycopg2 not installed. Install with: pip install psycopg2-binary", file=sys.stderr)
 
+# numpy chỉ dùng để chấm điểm BM25 vectorized; không có thì dùng vòng lặp Python (cùng kết quả)
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
 # Set UTF-8 encoding cho stdout/stderr trên Windows
 if sys.platform == 'win32':
     try:
@@ -30,6 +43,167 @@ if sys.platform == 'win32':
         sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
         sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
 
+# train() NOTIFY kênh này (payload = task_type) khi lưu model mới; server LISTEN để hot reload
+MODEL_NOTIFY_CHANNEL = 'aiesp_model_updated'
+# Khoảng thời gian tối đa giữa hai lần probe trained_at (bắt cả model được ghi mà không NOTIFY)
+RELOAD_INTERVAL_SECONDS = float(os.getenv('AIESP_RELOAD_INTERVAL_S', '30'))
+
+# Số conversation patterns tối đa lưu trong model_state (matching dùng posting lists nên không scan cả list)
+MAX_CONVERSATION_PATTERNS = int(os.getenv('AIESP_MAX_PATTERNS', '500'))
+# Pattern được coi là match khi message chứa ít nhất số keywords này
+MIN_KEYWORD_HITS = 2
+# Tham số BM25 (giá trị chuẩn)
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(r'\b\w+\b')
+
+def tokenize(text: str) -> set:
+    """Tập token lowercase của text (cùng regex với _extract_keywords)"""
+    return set(_TOKEN_RE.findall(text.lower()))
+
+def _pattern_keywords(pattern: Dict) -> List[str]:
+    return list(dict.fromkeys(k.lower() for k in pattern.get('keywords', [])))
+
+def build_pattern_matrix(patterns: List[Dict]) -> Dict[str, Any]:
+    """
+    Ma trận BM25 term × pattern dạng CSR, lưu được bằng JSON trong model_state.
+    Row của term i là posting list indices[indptr[i]:indptr[i+1]] (pattern id tăng dần) với weight BM25 trong data.
+    Keywords của một pattern là unique nên tf = 1; idf và avgdl được lưu kèm để chấm pattern ngoài ma trận.
+    """
+    postings = {}
+    lengths = []
+    for pattern_id, pattern in enumerate(patterns):
+        keywords = _pattern_keywords(pattern)
+        lengths.append(len(keywords))
+        for kw in keywords:
+            postings.setdefault(kw, []).append(pattern_id)
+    
+    n_patterns = len(patterns)
+    avgdl = sum(lengths) / n_patterns if n_patterns else 0.0
+    terms, idf, indptr, indices, data = [], [], [0], [], []
+    for term, pattern_ids in postings.items():
+        term_idf = math.log(1 + (n_patterns - len(pattern_ids) + 0.5) / (len(pattern_ids) + 0.5))
+        terms.append(term)
+        idf.append(term_idf)
+        indices.extend(pattern_ids)
+        data.extend(_bm25_weight(term_idf, lengths[pattern_id], avgdl) for pattern_id in pattern_ids)
+        indptr.append(len(indices))
+    return {'n_patterns': n_patterns, 'avgdl': avgdl, 'terms': terms, 'idf': idf,
+            'indptr': indptr, 'indices': indices, 'data': data}
+
+def _bm25_weight(idf: float, length: int, avgdl: float) -> float:
+    return idf * (BM25_K1 + 1) / (1 + BM25_K1 * (1 - BM25_B + BM25_B * length / avgdl))
+
+class PatternMatrix:
+    """Xếp hạng conversation patterns theo BM25 với một message (dạng runtime của build_pattern_matrix)"""
+    
+    def __init__(self, matrix: Dict[str, Any]):
+        self.n_patterns = matrix['n_patterns']
+        self.avgdl = matrix['avgdl']
+        self.rows = {term: row for row, term in enumerate(matrix['terms'])}
+        self.idf = matrix['idf']
+        if HAS_NUMPY:
+            self.indptr = np.asarray(matrix['indptr'], dtype=np.int64)
+            self.indices = np.asarray(matrix['indices'], dtype=np.int64)
+            self.data = np.asarray(matrix['data'], dtype=np.float64)
+        else:
+            self.indptr, self.indices, self.data = matrix['indptr'], matrix['indices'], matrix['data']
+    
+    def top_k(self, tokens: set, k: int, min_hits: int = MIN_KEYWORD_HITS) -> List[int]:
+        """
+        Pattern ids có >= min_hits keywords trong tokens, theo BM25 giảm dần (bằng điểm thì giữ thứ tự gốc).
+        Chỉ đụng tới posting lists của các token có trong vocabulary.
+        """
+        rows = [self.rows[token] for token in tokens if token in self.rows]
+        if not rows:
+            return []
+        if not HAS_NUMPY:
+            return self._top_k_python(rows, k, min_hits)
+        
+        spans = [(self.indptr[row], self.indptr[row + 1]) for row in rows]
+        cols = np.concatenate([self.indices[start:end] for start, end in spans])
+        weights = np.concatenate([self.data[start:end] for start, end in spans])
+        # q · W với q nhị phân: cộng các row của query terms theo cột (pattern)
+        scores = np.bincount(cols, weights=weights, minlength=self.n_patterns)
+        hits = np.bincount(cols, minlength=self.n_patterns)
+        candidates = np.flatnonzero(hits >= min_hits)
+        if candidates.size == 0:
+            return []
+        cand_scores = scores[candidates]
+        if candidates.size > k:
+            # Giữ mọi candidate bằng điểm thứ k để tie-break theo pattern id vẫn đúng
+            kth = np.partition(cand_scores, candidates.size - k)[candidates.size - k]
+            keep = cand_scores >= kth
+            candidates, cand_scores = candidates[keep], cand_scores[keep]
+        order = np.lexsort((candidates, -cand_scores))[:k]
+        return candidates[order].tolist()
+    
+    def _top_k_python(self, rows: List[int], k: int, min_hits: int) -> List[int]:
+        scores = {}
+        hits = Counter()
+        for row in rows:
+            for j in range(self.indptr[row], self.indptr[row + 1]):
+                pattern_id = self.indices[j]
+                scores[pattern_id] = scores.get(pattern_id, 0.0) + self.data[j]
+                hits[pattern_id] += 1
+        candidates = [pattern_id for pattern_id, count in hits.items() if count >= min_hits]
+        return sorted(candidates, key=lambda pattern_id: (-scores[pattern_id], pattern_id))[:k]
+    
+    def score(self, pattern: Dict, tokens: set) -> float:
+        """BM25 của một pattern bất kỳ (vd. trong topic/context groups) theo idf của ma trận"""
+        keywords = _pattern_keywords(pattern)
+        if not self.avgdl:
+            return 0.0
+        return sum(_bm25_weight(self.idf[self.rows[kw]], len(keywords), self.avgdl)
+                   for kw in keywords if kw in tokens and kw in self.rows)
+
+# Lexicons của rule-based responders, topic và response style, build một lần khi import.
+# Rules là tuple (category, keywords) theo thứ tự ưu tiên; keyword so khớp theo substring (như `word in text`).
+CONVERSATION_RULES = (
+    ('sad', ('sad', 'unhappy', 'depressed', 'down', 'bad')),
+    ('happy', ('happy', 'excited', 'great', 'good', 'amazing')),
+    ('worried', ('worried', 'anxious', 'nervous', 'scared')),
+    ('thanks', ('thank', 'thanks')),
+)
+PRACTICE_RULES = (
+    ('practice', ('practice', 'practicing', 'pronunciation')),
+    ('improve', ('improve', 'better', 'skills')),
+    ('nervous', ('nervous', 'afraid', 'scared', 'worried')),
+)
+GAME_RULES = (
+    ('find', ('key', 'door', 'open', 'find')),
+    ('quest', ('quest', 'mission', 'complete', 'finish')),
+    ('stuck', ('stuck', 'help', 'what', 'next', 'do')),
+    ('progress', ('talked', 'spoke', 'said', 'told')),
+    ('collect', ('collect', 'items', 'get', 'need')),
+)
+STYLE_RULES = (
+    ('questioning', ('?', 'what', 'how', 'why', 'tell me')),
+    ('empathetic', ('sorry', 'understand', 'feel')),
+    ('encouraging', ('great', 'awesome', 'amazing', 'congratulations')),
+    ('agreeing', ('okay', 'sure', 'yes', 'alright')),
+)
+TOPIC_KEYWORDS = (
+    ('emotion', ('sad', 'happy', 'angry', 'worried', 'anxious', 'excited', 'depressed', 'nervous', 'scared')),
+    ('work', ('work', 'job', 'office', 'boss', 'colleague', 'project', 'meeting', 'career')),
+    ('family', ('family', 'parent', 'mother', 'father', 'sibling', 'brother', 'sister', 'child')),
+    ('relationship', ('friend', 'boyfriend', 'girlfriend', 'partner', 'love', 'relationship', 'dating')),
+    ('health', ('health', 'sick', 'ill', 'doctor', 'hospital', 'pain', 'tired', 'sleep')),
+    ('education', ('school', 'study', 'exam', 'test', 'homework', 'teacher', 'student', 'learn')),
+    ('hobby', ('hobby', 'sport', 'music', 'movie', 'book', 'game', 'travel', 'cooking')),
+    ('future', ('future', 'plan', 'dream', 'goal', 'wish', 'hope', 'want', 'aspiration')),
+)
+
+def match_rule(text: str, rules: Tuple) -> str:
+    """Category đầu tiên (theo thứ tự ưu tiên) có keyword nằm trong text, None nếu không có"""
+    # Vòng lặp thường + `in` của str: dừng ở keyword đầu tiên match, không tạo generator cho mỗi rule
+    for category, keywords in rules:
+        for kw in keywords:
+            if kw in text:
+                return category
+    return None
+
 def get_db_connection():
     """Kết nối PostgreSQL database"""
     if not HAS_PSYCOPG2:
@@ -68,6 +242,9 @@ class AiESP:
         self.task_type = task_type
         self.model_state = {}
         self.accuracy = 0.0
+        self.trained_at = None  # version của row assistant_ai_models đang dùng
+        self.load_error = None
+        self._pattern_matrix = None  # PatternMatrix build từ model_state['pattern_matrix'] khi cần
         self.load_model(task_type)
     
     def load_model(self, task_type='translation_check'):
@@ -77,7 +254,7 @@ class AiESP:
             cursor = conn.cursor()
             
             cursor.execute('''
-                SELECT model_state, accuracy_score 
+                SELECT model_state, accuracy_score, trained_at 
                 FROM assistant_ai_models 
                 WHERE task_type = %s
                 ORDER BY trained_at DESC 
@@ -85,6 +262,7 @@ class AiESP:
             ''', [task_type])
             
             result = cursor.fetchone()
+            self.trained_at = result[2] if result else None
             if result and result[0]:
                 try:
                     self.model_state = result[0] if isinstance(result[0], dict) else json.loads(result[0])
@@ -99,6 +277,7 @@ class AiESP:
             conn.close()
         except Exception as e:
             print(f"[AiESP] Error loading model: {e}", file=sys.stderr)
+            self.load_error = e
             self.model_state = {}
             self.accuracy = 0.0
     
@@ -136,10 +315,11 @@ class AiESP:
         matched_patterns = []
         
         # 2a. Match theo topic trước (ưu tiên)
+        tokens = tokenize(user_message)
         topic_patterns = self.model_state.get('topic_patterns', {})
         if topic in topic_patterns:
             for pattern in topic_patterns[topic]:
-                if self._match_conversation_pattern(user_message, pattern):
+                if self._match_conversation_pattern(user_message, pattern, tokens):
                     matched_patterns.append(pattern)
         
         # 2b. Match theo context
@@ -147,18 +327,17 @@ class AiESP:
         context_patterns = self.model_state.get('context_patterns', {})
         if context_key in context_patterns:
             for pattern in context_patterns[context_key]:
-                if self._match_conversation_pattern(user_message, pattern):
+                if self._match_conversation_pattern(user_message, pattern, tokens):
                     if pattern not in matched_patterns:
                         matched_patterns.append(pattern)
         
-        # 2c. Match theo keywords (fallback)
+        # 2c. Match theo keywords (fallback), đã xếp hạng theo BM25
         if not matched_patterns:
-            all_patterns = self.model_state.get('conversation_patterns', [])
-            for pattern in all_patterns:
-                if self._match_conversation_pattern(user_message, pattern):
-                    matched_patterns.append(pattern)
-                    if len(matched_patterns) >= 5:  # Giới hạn 5 patterns
-                        break
+            matched_patterns = self._find_matching_patterns(tokens, limit=5)  # Giới hạn 5 patterns
+        else:
+            # Topic/context matches vẫn được ưu tiên, nhưng xếp hạng theo BM25 thay vì thứ tự lưu
+            matrix = self._get_pattern_matrix()
+            matched_patterns.sort(key=lambda pattern: -matrix.score(pattern, tokens))
         
         # 3. Chọn response với sự ngẫu nhiên (không chỉ dùng pattern đầu tiên)
         if matched_patterns:
@@ -176,35 +355,61 @@ class AiESP:
     
     def _rule_based_conversation(self, user_message: str, history: List[Dict]) -> str:
         """Rule-based conversation - đơn giản nhưng tự nhiên"""
-        user_lower = user_message.lower()
+        rule = match_rule(user_message.lower(), CONVERSATION_RULES)
         
         # Emotional responses
-        if any(word in user_lower for word in ['sad', 'unhappy', 'depressed', 'down', 'bad']):
+        if rule == 'sad':
             return "Oh no... that sounds really hard. I'm here with you. What's going on?"
         
-        if any(word in user_lower for word in ['happy', 'excited', 'great', 'good', 'amazing']):
+        if rule == 'happy':
             return "That's awesome! I'm so happy for you! Tell me more about it!"
         
-        if any(word in user_lower for word in ['worried', 'anxious', 'nervous', 'scared']):
+        if rule == 'worried':
             return "I understand that feeling. It's okay to feel that way. What's on your mind?"
         
-        if any(word in user_lower for word in ['thank', 'thanks']):
+        if rule == 'thanks':
             return "You're welcome! I'm here whenever you need me."
         
         # Default empathetic response
         return "I hear you. That sounds important. Can you tell me more?"
     
-    def _match_conversation_pattern(self, user_message: str, pattern: Dict) -> bool:
+    def _match_conversation_pattern(self, user_message: str, pattern: Dict, tokens: set = None) -> bool:
         """Kiểm tra xem user message có match với pattern không - CẢI THIỆN ĐỂ HIỂU NGỮ CẢNH"""
         keywords = pattern.get('keywords', [])
         if not keywords:
             return False
         
-        user_lower = user_message.lower()
+        if tokens is None:
+            tokens = tokenize(user_message)
         
         # Match ít nhất 2 keywords (để chính xác hơn)
-        matched_keywords = sum(1 for kw in keywords if kw.lower() in user_lower)
-        return matched_keywords >= 2
+        matched_keywords = sum(1 for kw in dict.fromkeys(k.lower() for k in keywords) if kw in tokens)
+        return matched_keywords >= MIN_KEYWORD_HITS
+    
+    def _get_pattern_matrix(self) -> PatternMatrix:
+        """
+        PatternMatrix của conversation_patterns hiện tại. Model cũ (train trước khi có ma trận BM25)
+        hoặc ma trận lệch với patterns thì build lại lần đầu cần.
+        """
+        if self._pattern_matrix is None:
+            patterns = self.model_state.get('conversation_patterns', [])
+            matrix = self.model_state.get('pattern_matrix')
+            if matrix is None or matrix.get('n_patterns') != len(patterns):
+                matrix = build_pattern_matrix(patterns)
+                self.model_state['pattern_matrix'] = matrix
+            self._pattern_matrix = PatternMatrix(matrix)
+        return self._pattern_matrix
+    
+    def _find_matching_patterns(self, tokens: set, limit: int = 5) -> List[Dict]:
+        """
+        Các conversation_patterns có >= MIN_KEYWORD_HITS keywords nằm trong tokens, xếp hạng theo BM25.
+        Chỉ duyệt posting list của các token trong message thay vì toàn bộ patterns.
+        """
+        patterns = self.model_state.get('conversation_patterns', [])
+        if not patterns:
+            return []
+        ranked = self._get_pattern_matrix().top_k(tokens, limit)
+        return [patterns[pattern_id] for pattern_id in ranked]
     
     def _generate_speaking_practice_response(self, input_data: Dict[str, Any]) -> str:
         """Generate speaking practice response - hỗ trợ luyện tập"""
@@ -215,28 +420,25 @@ class AiESP:
         if self.accuracy < 0.5:
             return self._rule_based_practice_response(user_message, history)
         
-        # Sử dụng patterns đã học
-        patterns = self.model_state.get('conversation_patterns', [])
-        
-        # Tìm pattern phù hợp
-        for pattern in patterns:
-            if self._match_conversation_pattern(user_message, pattern):
-                return pattern.get('response', '')
+        # Tìm pattern đã học phù hợp nhất (BM25)
+        matches = self._find_matching_patterns(tokenize(user_message), limit=1)
+        if matches:
+            return matches[0].get('response', '')
         
         # Fallback về rule-based
         return self._rule_based_practice_response(user_message, history)
     
     def _rule_based_practice_response(self, user_message: str, history: List[Dict]) -> str:
         """Rule-based practice response"""
-        user_lower = user_message.lower()
+        rule = match_rule(user_message.lower(), PRACTICE_RULES)
         
-        if any(word in user_lower for word in ['practice', 'practicing', 'pronunciation']):
+        if rule == 'practice':
             return "Great! Let's practice together. What word or phrase would you like to work on? I'll help you pronounce it correctly."
         
-        if any(word in user_lower for word in ['improve', 'better', 'skills']):
+        if rule == 'improve':
             return "That's wonderful! Practice makes perfect. Let's work on your speaking skills together. What would you like to practice?"
         
-        if any(word in user_lower for word in ['nervous', 'afraid', 'scared', 'worried']):
+        if rule == 'nervous':
             return "I understand that feeling. It's completely normal to feel nervous. Let's start with something easy and build your confidence. What topic are you comfortable talking about?"
         
         return "I'm here to help you practice! What would you like to work on today?"
@@ -250,34 +452,31 @@ class AiESP:
         if self.accuracy < 0.5:
             return self._rule_based_game_response(user_message, history)
         
-        # Sử dụng patterns đã học
-        patterns = self.model_state.get('conversation_patterns', [])
-        
-        # Tìm pattern phù hợp
-        for pattern in patterns:
-            if self._match_conversation_pattern(user_message, pattern):
-                return pattern.get('response', '')
+        # Tìm pattern đã học phù hợp nhất (BM25)
+        matches = self._find_matching_patterns(tokenize(user_message), limit=1)
+        if matches:
+            return matches[0].get('response', '')
         
         # Fallback về rule-based
         return self._rule_based_game_response(user_message, history)
     
     def _rule_based_game_response(self, user_message: str, history: List[Dict]) -> str:
         """Rule-based game conversation response"""
-        user_lower = user_message.lower()
+        rule = match_rule(user_message.lower(), GAME_RULES)
         
-        if any(word in user_lower for word in ['key', 'door', 'open', 'find']):
+        if rule == 'find':
             return "You're looking for something? Let me help you. Have you talked to the shopkeeper? They might know where it is. Or maybe check with the librarian - they often have information about important items."
         
-        if any(word in user_lower for word in ['quest', 'mission', 'complete', 'finish']):
+        if rule == 'quest':
             return "To complete this quest, you'll need to talk to several people. First, visit the village elder to get information. Then, speak with the merchant to get supplies. Finally, talk to the guard to get permission. Each person has a piece of the puzzle!"
         
-        if any(word in user_lower for word in ['stuck', 'help', 'what', 'next', 'do']):
+        if rule == 'stuck':
             return "Don't worry! There are many people who can help you. Try talking to: the guide at the entrance, the helper at the market, or the advisor at the castle. Each person has different information and can guide you in different ways."
         
-        if any(word in user_lower for word in ['talked', 'spoke', 'said', 'told']):
+        if rule == 'progress':
             return "Good progress! Based on what you learned, try talking to the next person in the chain. Each conversation brings you closer to your goal!"
         
-        if any(word in user_lower for word in ['collect', 'items', 'get', 'need']):
+        if rule == 'collect':
             return "To collect items, you'll need to talk to different people. The collector has rare items, the trader has common supplies, and the artisan can create special items. Start by talking to the collector!"
         
         return "To progress in this game, you need to interact with different characters. Try talking to: the farmer, the blacksmith, or the scholar. Each conversation will help you get closer to completing your goal!"
@@ -392,7 +591,11 @@ class AiESP:
             cursor.execute('''
                 INSERT INTO assistant_ai_models (task_type, accuracy_score, model_state, trained_at)
                 VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
+                RETURNING trained_at
             ''', [self.task_type, self.accuracy, json.dumps(self.model_state)])
+            self.trained_at = cursor.fetchone()[0]
+            # Báo cho các server đang chạy (gửi đi khi commit)
+            cursor.execute('SELECT pg_notify(%s, %s)', [MODEL_NOTIFY_CHANNEL, self.task_type])
             
             conn.commit()
             conn.close()
@@ -461,7 +664,10 @@ class AiESP:
                 continue
         
         # Lưu tất cả patterns và topic/context groups
-        self.model_state['conversation_patterns'] = conversation_patterns[:500]  # Tăng lên 500 patterns
+        self.model_state['conversation_patterns'] = conversation_patterns[:MAX_CONVERSATION_PATTERNS]
+        # Ma trận BM25 term × pattern (CSR), để matching chỉ cần tra token thay vì scan mọi pattern
+        self.model_state['pattern_matrix'] = build_pattern_matrix(self.model_state['conversation_patterns'])
+        self._pattern_matrix = None
         self.model_state['topic_patterns'] = {k: v[:20] for k, v in topic_patterns.items()}  # Top 20 mỗi topic
         self.model_state['context_patterns'] = {k: v[:20] for k, v in context_patterns.items()}  # Top 20 mỗi context
         self.accuracy = correct_count / total_count if total_count > 0 else 0.0
@@ -516,18 +722,6 @@ class AiESP:
     
     def _extract_topic(self, user_message: str, history: List[Dict]) -> str:
         """Extract topic từ user message và history"""
-        # Common topics
-        topics = {
-            'emotion': ['sad', 'happy', 'angry', 'worried', 'anxious', 'excited', 'depressed', 'nervous', 'scared'],
-            'work': ['work', 'job', 'office', 'boss', 'colleague', 'project', 'meeting', 'career'],
-            'family': ['family', 'parent', 'mother', 'father', 'sibling', 'brother', 'sister', 'child'],
-            'relationship': ['friend', 'boyfriend', 'girlfriend', 'partner', 'love', 'relationship', 'dating'],
-            'health': ['health', 'sick', 'ill', 'doctor', 'hospital', 'pain', 'tired', 'sleep'],
-            'education': ['school', 'study', 'exam', 'test', 'homework', 'teacher', 'student', 'learn'],
-            'hobby': ['hobby', 'sport', 'music', 'movie', 'book', 'game', 'travel', 'cooking'],
-            'future': ['future', 'plan', 'dream', 'goal', 'wish', 'hope', 'want', 'aspiration']
-        }
-        
         text = user_message.lower()
         if history:
             # Thêm context từ history
@@ -535,17 +729,16 @@ class AiESP:
                 if isinstance(h, dict):
                     text += ' ' + (h.get('text_content', '') or h.get('ai_response', '')).lower()
         
-        # Tìm topic phù hợp nhất
-        topic_scores = {}
-        for topic, keywords in topics.items():
-            score = sum(1 for kw in keywords if kw in text)
-            if score > 0:
-                topic_scores[topic] = score
-        
-        if topic_scores:
-            return max(topic_scores, key=topic_scores.get)
-        
-        return 'general'
+        # Tìm topic phù hợp nhất (score = số keywords của topic có trong text; bằng điểm thì topic đứng trước thắng)
+        best_topic, best_score = 'general', 0
+        for topic, keywords in TOPIC_KEYWORDS:
+            score = 0
+            for kw in keywords:
+                if kw in text:
+                    score += 1
+            if score > best_score:
+                best_topic, best_score = topic, score
+        return best_topic
     
     def _extract_context_keywords(self, history: List[Dict]) -> List[str]:
         """Extract context keywords từ history"""
@@ -565,18 +758,7 @@ class AiESP:
     
     def _classify_response_style(self, response: str) -> str:
         """Phân loại style của response"""
-        response_lower = response.lower()
-        
-        if any(word in response_lower for word in ['?', 'what', 'how', 'why', 'tell me']):
-            return 'questioning'
-        elif any(word in response_lower for word in ['sorry', 'understand', 'feel']):
-            return 'empathetic'
-        elif any(word in response_lower for word in ['great', 'awesome', 'amazing', 'congratulations']):
-            return 'encouraging'
-        elif any(word in response_lower for word in ['okay', 'sure', 'yes', 'alright']):
-            return 'agreeing'
-        else:
-            return 'general'
+        return match_rule(response.lower(), STYLE_RULES) or 'general'
     
     def _add_response_variation(self, response: str, user_message: str, history: List[Dict]) -> str:
         """Thêm variation nhỏ cho response để tự nhiên hơn"""
@@ -585,14 +767,218 @@ class AiESP:
         return response
 
 
+# Server mode: giữ một AiESP (model_state đã parse) cho mỗi task type trong process,
+# không phải spawn Python + mở kết nối Postgres + parse model_state cho từng message
+_MODEL_REGISTRY: Dict[str, AiESP] = {}
+_REGISTRY_LOCK = threading.Lock()
+
+def get_model(task_type: str) -> AiESP:
+    """AiESP thường trú cho task_type, chỉ load từ database ở lần đầu"""
+    ai = _MODEL_REGISTRY.get(task_type)
+    if ai is None:
+        with _REGISTRY_LOCK:
+            ai = _MODEL_REGISTRY.get(task_type)
+            if ai is None:
+                ai = AiESP(task_type=task_type)
+                _MODEL_REGISTRY[task_type] = ai
+    return ai
+
+def reload_model(task_type: str) -> AiESP:
+    """
+    Load lại model mới nhất và thay instance trong registry bằng một phép gán.
+    Request đang chạy giữ instance cũ nên không bao giờ thấy model_state load dở.
+    Load lỗi thì giữ nguyên model cũ.
+    """
+    current = _MODEL_REGISTRY.get(task_type)
+    fresh = AiESP(task_type=task_type)
+    if fresh.load_error is not None and current is not None:
+        print(f"[AiESP] Reload failed for {task_type}, keeping model trained at {current.trained_at}", file=sys.stderr)
+        return current
+    with _REGISTRY_LOCK:
+        _MODEL_REGISTRY[task_type] = fresh
+    if current is None or fresh.trained_at != current.trained_at:
+        print(f"[AiESP] Loaded {task_type} model trained at {fresh.trained_at}", file=sys.stderr)
+    return fresh
+
+def fetch_model_versions(conn, task_types: List[str]) -> Dict[str, Any]:
+    """trained_at mới nhất của từng task type (chỉ đọc một cột, không kéo model_state)"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT task_type, MAX(trained_at)
+        FROM assistant_ai_models
+        WHERE task_type = ANY(%s)
+        GROUP BY task_type
+    ''', [list(task_types)])
+    versions = dict(cursor.fetchall())
+    cursor.close()
+    return versions
+
+class ModelWatcher(threading.Thread):
+    """
+    Hot reload cho server mode: LISTEN kênh MODEL_NOTIFY_CHANNEL để reload ngay khi train() lưu model,
+    và probe trained_at sau mỗi interval không có notification.
+    """
+    def __init__(self, interval: float = RELOAD_INTERVAL_SECONDS):
+        super().__init__(name='aiesp-model-watcher', daemon=True)
+        self.interval = interval
+
+    def run(self):
+        conn = None
+        while True:
+            try:
+                if conn is None:
+                    conn = get_db_connection()
+                    conn.autocommit = True
+                    cursor = conn.cursor()
+                    cursor.execute(f'LISTEN {MODEL_NOTIFY_CHANNEL}')
+                    cursor.close()
+                    # Bắt kịp các model được train trong lúc chưa LISTEN
+                    self.probe(conn)
+                readable, _, _ = select.select([conn], [], [], self.interval)
+                if readable:
+                    conn.poll()
+                    task_types = {notify.payload for notify in conn.notifies}
+                    conn.notifies.clear()
+                    for task_type in task_types:
+                        if task_type in _MODEL_REGISTRY:
+                            reload_model(task_type)
+                else:
+                    self.probe(conn)
+            except Exception as e:
+                print(f"[AiESP] Model watcher error: {e}", file=sys.stderr)
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                conn = None
+                time.sleep(self.interval)
+
+    def probe(self, conn):
+        task_types = list(_MODEL_REGISTRY)
+        if not task_types:
+            return
+        for task_type, trained_at in fetch_model_versions(conn, task_types).items():
+            current = _MODEL_REGISTRY.get(task_type)
+            if current is not None and trained_at != current.trained_at:
+                reload_model(task_type)
+
+def handle_request(request: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    request: {"id", "command": "conversation" | "check_translation" | "reload", "task_type"?, "input": {...}}
+    Trả về {"id", "ok": True, "result"} hoặc {"id", "ok": False, "error"}
+    """
+    request_id = request.get('id')
+    try:
+        command = request.get('command', 'conversation')
+        # Giống CLI: task_type mặc định là translation_check
+        task_type = request.get('task_type') or 'translation_check'
+        input_data = request.get('input') or {}
+        if command == 'reload':
+            ai = reload_model(task_type)
+            trained_at = ai.trained_at.isoformat() if ai.trained_at else None
+            return {'id': request_id, 'ok': True, 'result': {'task_type': task_type, 'trained_at': trained_at}}
+        ai = get_model(task_type)
+        if command == 'conversation':
+            result = ai.generate_response(input_data)
+        elif command == 'check_translation':
+            result = ai._generate_translation_check(input_data)
+        else:
+            raise ValueError(f"Unknown command: {command}")
+        return {'id': request_id, 'ok': True, 'result': result}
+    except Exception as e:
+        traceback.print_exc(file=sys.stderr)
+        return {'id': request_id, 'ok': False, 'error': str(e)}
+
+def _handle_line(line: str) -> Dict[str, Any]:
+    try:
+        request = json.loads(line)
+    except ValueError as e:
+        return {'id': None, 'ok': False, 'error': f"Invalid JSON: {e}"}
+    if not isinstance(request, dict):
+        # Dòng JSON hợp lệ nhưng không phải object (vd. [1]) không được làm chết server/connection
+        return {'id': None, 'ok': False, 'error': "Request must be a JSON object"}
+    return handle_request(request)
+
+def _serve_stdin():
+    # Mỗi dòng stdin là một request JSON, mỗi dòng stdout là một response JSON
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        response = _handle_line(line)
+        sys.stdout.write(json.dumps(response, ensure_ascii=False) + "\n")
+        sys.stdout.flush()
+
+def _serve_socket(socket_path: str):
+    import socketserver
+
+    if not hasattr(socketserver, "UnixStreamServer"):
+        raise RuntimeError("Unix socket không được hỗ trợ trên hệ điều hành này, hãy dùng stdin mode")
+
+    # generate_response chỉ đọc model_state nên các connection được xử lý song song
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for raw in self.rfile:
+                line = raw.decode("utf-8").strip()
+                if not line:
+                    continue
+                response = _handle_line(line)
+                self.wfile.write((json.dumps(response, ensure_ascii=False) + "\n").encode("utf-8"))
+                self.wfile.flush()
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with Server(socket_path, RequestHandler) as server:
+        print(f"[AiESP] Server listening on {socket_path}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        finally:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+
+def serve(argv: List[str]):
+    """Server mode: nhận request qua stdin (JSON lines) hoặc Unix socket"""
+    parser = argparse.ArgumentParser(prog="assistantAI.py serve", description="Long-running AiESP server with resident models per task type.")
+    parser.add_argument("--socket", default=None, help="Unix socket path. If omitted, read requests from stdin as JSON lines.")
+    parser.add_argument("--preload", nargs="*", default=[], metavar="TASK_TYPE",
+                        help="Task types to load at startup (others are loaded on first request)")
+    parser.add_argument("--reload-interval", type=float, default=RELOAD_INTERVAL_SECONDS,
+                        help=f"Seconds between trained_at probes when no NOTIFY arrives; 0 disables hot reload (env AIESP_RELOAD_INTERVAL_S, default {RELOAD_INTERVAL_SECONDS:g})")
+    args = parser.parse_args(argv)
+
+    for task_type in args.preload:
+        get_model(task_type)
+    if args.reload_interval > 0 and HAS_PSYCOPG2:
+        ModelWatcher(args.reload_interval).start()
+
+    ready = {'event': 'ready', 'task_types': sorted(_MODEL_REGISTRY), 'pid': os.getpid()}
+    if args.socket:
+        ready['socket'] = args.socket
+    print(json.dumps(ready, ensure_ascii=False), flush=True)
+    try:
+        if args.socket:
+            _serve_socket(args.socket)
+        else:
+            _serve_stdin()
+    except KeyboardInterrupt:
+        pass
+
+
 def main():
     """Main function - hỗ trợ nhiều commands"""
     if len(sys.argv) < 2:
         print("Usage: python assistantAI.py <command> [task_type] [args...]", file=sys.stderr)
-        print("Commands: conversation, translation_check, train, check_translation", file=sys.stderr)
+        print("Commands: conversation, translation_check, train, check_translation, serve", file=sys.stderr)
         sys.exit(1)
     
     command = sys.argv[1]
+    if command == 'serve':
+        serve(sys.argv[2:])
+        return
     task_type = sys.argv[2] if len(sys.argv) > 2 else 'translation_check'
     
     ai = AiESP(task_type=task_type)
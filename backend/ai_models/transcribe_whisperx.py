@@ -1,11 +1,22 @@
 #!/usr/bin/env python3
-import whisperx
-import torch
 import os
+import time
+# Chỉ load model từ local store, không tra cứu Hugging Face (phải set trước khi import whisperx)
+if os.getenv("WHISPERX_OFFLINE") == "1":
+    os.environ.setdefault("HF_HUB_OFFLINE", "1")
+    os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
 import sys
 import json
 import argparse
 import traceback
+import hashlib
+import shutil
+from bisect import bisect_left
+import threading
+import re
+from collections import Counter, OrderedDict
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
 
 # Ensure stdout/stderr use UTF-8 (prevents UnicodeEncodeError on Windows)
 try:
@@ -14,51 +25,147 @@ try:
 except Exception:
     pass
 
+# whisperx + torch mất vài giây để import: chỉ import khi thực sự cần model/audio,
+# để --help, lỗi tham số, file không tồn tại và cache hit trả về ngay
+IMPORT_SECONDS = None
+
+class _LazyModule:
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        load_backends()
+        return getattr(sys.modules[self._name], attr)
+
+whisperx = _LazyModule("whisperx")
+torch = _LazyModule("torch")
+
+def backends_loaded():
+    return IMPORT_SECONDS is not None
+
+def load_backends():
+    """Import whisperx và torch (một lần cho cả process)."""
+    global IMPORT_SECONDS
+    if IMPORT_SECONDS is None:
+        started = time.perf_counter()
+        import whisperx as _whisperx  # noqa: F401
+        import torch as _torch  # noqa: F401
+        IMPORT_SECONDS = time.perf_counter() - started
+        print(f"[whisperx] Imported whisperx/torch in {IMPORT_SECONDS:.2f}s - transcribe_whisperx.py:32", flush=True)
+
 # Optional: lightweight language detection per word
-# langdetect đôi khi không chính xác với từ rất ngắn; dùng cho đánh dấu tham khảo
+# langdetect đôi khi không chính xác với từ rất ngắn; chỉ dùng cho token không phân loại được bằng fast path
 try:
-    from langdetect import detect
+    from langdetect import detect, DetectorFactory
+    DetectorFactory.seed = 0  # langdetect mặc định random -> cố định để kết quả ổn định
 except Exception:
     detect = None
 
+# Optional: msgpack cho output compact dạng binary (--format msgpack)
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Fast path gắn nhãn ngôn ngữ theo từ: dấu tiếng Việt, script non-Latin, lexicon EN/VI
+_VI_LETTERS = "àáạảãâầấậẩẫăằắặẳẵèéẹẻẽêềếệểễìíịỉĩòóọỏõôồốộổỗơờớợởỡùúụủũưừứựửữỳýỵỷỹđ"
+_VI_LETTER_RE = re.compile(f"[{_VI_LETTERS}]")
+# Latin cơ bản + Latin Extended-A/B; ký tự ngoài các block này coi là non-Latin
+_NON_LATIN_RE = re.compile(r"[^\u0000-\u024F]")
+_EDGE_PUNCT_RE = re.compile(r"^[\W_]+|[\W_]+$")
+# Tiếng Việt không dùng f, j, w, z -> token có các chữ này gần như chắc chắn là tiếng Anh
+_EN_ONLY_LETTER_RE = re.compile(r"[fjwz]")
+
+_EN_LEXICON = frozenset("""
+a about after again all also always am an and any are around as ask at back be because been before being best better big
+book both but by call came can car come could day did different do does doing done down each eat end even every family
+feel few find first for friend friends from fun get give go going good got great had happy has have he hello help her here
+him his home how i if important in interesting is it its just know last learn learning let life like little live long look
+lot love made make man many maybe me more morning most much my name need never new next nice night no not now of off often
+old on once one only or other our out over people place play please practice pretty really right said same say school see
+she should so some something sometimes speak speaking start still story study such sure take talk teacher tell than thank
+thanks that the their them then there these they thing things think this those time to today together too try two up us
+use usually very want was water way we well went were what when where which while who why will with work would yeah year
+years yes yesterday you your
+""".split())
+
+# Các âm tiết tiếng Việt không dấu phổ biến (Whisper đôi khi bỏ dấu) và không trùng từ tiếng Anh thông dụng
+_VI_LEXICON = frozenset("""
+anh chi cua dang duoc khong nguoi nhieu nhung rat roi thi trong vay voi cung biet muon hoc noi lam minh chung
+""".split())
+
+@lru_cache(maxsize=65536)
+def tag_token_language(token):
+    """Gắn nhãn ngôn ngữ cho một token (đã lowercase): en, vi, nonlatin, unknown hoặc kết quả langdetect."""
+    core = _EDGE_PUNCT_RE.sub("", token.replace("’", "'"))
+    if not core or not any(ch.isalpha() for ch in core):
+        return "unknown"
+    if _VI_LETTER_RE.search(core):
+        return "vi"
+    if _NON_LATIN_RE.search(core):
+        return "nonlatin"
+    base = core.split("'", 1)[0]
+    if core in _EN_LEXICON or base in _EN_LEXICON or _EN_ONLY_LETTER_RE.search(core):
+        return "en"
+    if core in _VI_LEXICON:
+        return "vi"
+    if detect:
+        # Token mơ hồ: mới dùng n-gram detection (kết quả được memo bởi lru_cache)
+        try:
+            return detect(core)
+        except Exception:
+            return "unknown"
+    return "en"
+
 def detect_language_per_word(words):
+    """Gắn w["lang"] cho mỗi word; mỗi token khác nhau chỉ được phân loại một lần."""
     if not isinstance(words, list):
         return []
+    tags = {}
     for w in words:
-        try:
-            token = w.get("word") if isinstance(w, dict) else None
-            if not token:
-                lang = "unknown"
-            elif detect:
-                lang = detect(token)
-            else:
-                # Fallback: heuristic theo unicode block (Latin vs non-Latin)
-                # rất thô nhưng đủ để đánh dấu non-English cơ bản
-                has_non_latin = any(ord(ch) > 0x024F for ch in token)
-                lang = "en" if not has_non_latin else "nonlatin"
-            w["lang"] = lang
-        except Exception:
+        if not isinstance(w, dict):
+            continue
+        token = w.get("word")
+        if not token or not isinstance(token, str):
             w["lang"] = "unknown"
+            continue
+        key = token.strip().lower()
+        lang = tags.get(key)
+        if lang is None:
+            lang = tags[key] = tag_token_language(key)
+        w["lang"] = lang
     return words
 
-def run_whisperx(audio_path, output_path="outputs/record.json", model_size="base", language=None, compute_type=None):
-    if not os.path.exists(audio_path):
-        raise FileNotFoundError(f"Không tìm thấy file audio: {audio_path}")
+# Model đã load được giữ lại trong process (worker mode dùng lại giữa các job), LRU giới hạn số model
+# để job gửi "threads"/model riêng không giữ thêm một ASR model tới hết đời process
+# key: (model_size, requested compute_type, cpu_threads) -> (model, device, compute_type)
+_MODEL_CACHE = OrderedDict()
+# Mặc định 2: đủ cho cascade (model nhỏ + escalation model)
+MODEL_CACHE_MAX_MODELS = int(os.getenv("WHISPERX_MODEL_CACHE_MAX_MODELS", "2"))
 
-    out_dir = os.path.dirname(output_path) or "."
-    os.makedirs(out_dir, exist_ok=True)
+# Compute types của CTranslate2. int8 / int8_float32 chạy được trên CPU, int8_float16 chỉ dùng cho GPU
+COMPUTE_TYPES = ["float16", "float32", "int8", "int8_float32", "int8_float16"]
+# Compute type mặc định khi chạy CPU (ví dụ đặt "int8" cho node chỉ có CPU)
+CPU_DEFAULT_COMPUTE_TYPE = os.getenv("WHISPERX_CPU_COMPUTE_TYPE", "float32")
+
+def cpu_compute_type(compute_type=None):
+    """Compute type dùng khi fallback về CPU: giữ int8 nếu đã chọn int8, còn lại dùng mặc định CPU."""
+    if compute_type and compute_type.startswith("int8"):
+        return "int8_float32" if compute_type == "int8_float16" else compute_type
+    return CPU_DEFAULT_COMPUTE_TYPE
 
+def resolve_device(compute_type=None):
+    """Chọn device (ưu tiên GPU) và compute_type tương ứng."""
     # Tự động phát hiện và ưu tiên GPU, với fallback về CPU nếu lỗi
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    original_device = device
-    
+
     # Tự động chọn compute_type dựa trên device
     # GPU: dùng float16 để nhanh hơn, CPU: dùng float32 để chính xác hơn
     if compute_type is None:
         if device == "cuda":
             compute_type = "float16"  # GPU: ưu tiên tốc độ
         else:
-            compute_type = "float32"  # CPU: ưu tiên độ chính xác
+            compute_type = cpu_compute_type()  # CPU: mặc định float32 (ưu tiên độ chính xác)
     
     # Log thông tin GPU nếu có - ưu tiên GPU laptop
     if device == "cuda":
@@ -76,13 +183,162 @@ def run_whisperx(audio_path, output_path="outputs/record.json", model_size="base
         except Exception as e:
             print(f"[whisperx] ⚠️  GPU detected but error accessing: {e}, falling back to CPU - transcribe_whisperx.py:74", flush=True)
             device = "cpu"
-            compute_type = "float32"
+            compute_type = cpu_compute_type(compute_type)
     else:
         print(f"[whisperx] ⚠️  GPU not available, using CPU - transcribe_whisperx.py:77", flush=True)
-    
-    print(f"[whisperx] Running on: {audio_path} - transcribe_whisperx.py:65", flush=True)
-    print(f"[whisperx] Model: {model_size} | Device: {device} | compute_type: {compute_type} - transcribe_whisperx.py:66", flush=True)
 
+    return device, compute_type
+
+def sha256_file(path, chunk_size=1024 * 1024):
+    """sha256 (hex) nội dung file, đọc theo chunk: dùng cho key transcript/PCM cache và checksum model store."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Model store offline: weights Whisper (CTranslate2) và align (wav2vec2) trong một thư mục local,
+# có manifest.json + sha256 từng file; load bằng path nên không cần tra cứu Hugging Face lúc chạy
+# Mặc định backend/models/whisperx, tính theo vị trí script (không phụ thuộc CWD)
+MODEL_STORE_DIR = os.getenv("WHISPERX_MODEL_STORE", os.path.normpath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models", "whisperx")))
+MODEL_STORE_MANIFEST = "manifest.json"
+_MANIFEST_CACHE = {}  # manifest path -> (mtime, manifest)
+
+def load_store_manifest():
+    path = os.path.join(MODEL_STORE_DIR, MODEL_STORE_MANIFEST)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return {"version": 1, "models": {}}
+    cached = _MANIFEST_CACHE.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    _MANIFEST_CACHE[path] = (mtime, manifest)
+    return manifest
+
+def save_store_manifest(manifest):
+    os.makedirs(MODEL_STORE_DIR, exist_ok=True)
+    path = os.path.join(MODEL_STORE_DIR, MODEL_STORE_MANIFEST)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def store_entry(key):
+    """(entry, path) của model trong store, key "whisper/<size>" hoặc "align/<lang>"; (None, None) nếu chưa có."""
+    entry = load_store_manifest().get("models", {}).get(key)
+    if not entry:
+        return None, None
+    path = os.path.join(MODEL_STORE_DIR, entry["path"])
+    return (entry, path) if os.path.isdir(path) else (None, None)
+
+def whisper_model_source(model_size):
+    """Path CTranslate2 trong store nếu đã prefetch, ngược lại tên model (resolve qua HF cache)."""
+    _, path = store_entry(f"whisper/{model_size}")
+    if path:
+        print(f"[whisperx] Loading {model_size} from model store: {path} - transcribe_whisperx.py:152", flush=True)
+        return path
+    return model_size
+
+def align_model_kwargs(language_code):
+    """kwargs cho whisperx.load_align_model để load align model từ store, {} nếu chưa có."""
+    entry, path = store_entry(f"align/{language_code}")
+    if not path:
+        return {}
+    if entry.get("source") == "torchaudio":
+        # torchaudio tìm checkpoint trong model_dir trước khi tải
+        return {"model_name": entry["name"], "model_dir": path}
+    return {"model_name": path}
+
+def _store_file_index(path):
+    files = {}
+    for root, dirs, names in os.walk(path):
+        # Bỏ metadata ẩn (.cache của huggingface_hub)
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(names):
+            if name.startswith("."):
+                continue
+            full = os.path.join(root, name)
+            rel = os.path.relpath(full, path).replace(os.sep, "/")
+            files[rel] = {"sha256": sha256_file(full), "bytes": os.path.getsize(full)}
+    return files
+
+def _default_align_model(language_code):
+    from whisperx.alignment import DEFAULT_ALIGN_MODELS_TORCH, DEFAULT_ALIGN_MODELS_HF
+    if language_code in DEFAULT_ALIGN_MODELS_TORCH:
+        return DEFAULT_ALIGN_MODELS_TORCH[language_code], "torchaudio"
+    if language_code in DEFAULT_ALIGN_MODELS_HF:
+        return DEFAULT_ALIGN_MODELS_HF[language_code], "huggingface"
+    raise ValueError(f"No default align-model for language: {language_code}")
+
+def prefetch_model(kind, name, force=False):
+    """Tải model vào store (kind: "whisper" | "align"), ghi checksums vào manifest."""
+    key = f"{kind}/{name}"
+    entry, path = store_entry(key)
+    if path and not force:
+        print(f"[whisperx] {key} already in model store - transcribe_whisperx.py:197", flush=True)
+        return entry
+
+    final_path = os.path.join(MODEL_STORE_DIR, kind, name)
+    # Tải vào thư mục tạm rồi rename: store không bao giờ chứa model tải dở
+    partial_path = final_path + ".partial"
+    shutil.rmtree(partial_path, ignore_errors=True)
+    os.makedirs(partial_path)
+    print(f"[whisperx] Prefetching {key} into {final_path} - transcribe_whisperx.py:205", flush=True)
+    if kind == "whisper":
+        from faster_whisper.utils import download_model
+        download_model(name, output_dir=partial_path)
+        entry = {"kind": kind, "name": name, "source": "faster-whisper"}
+    elif kind == "align":
+        model_name, source = _default_align_model(name)
+        if source == "torchaudio":
+            import torchaudio
+            torchaudio.pipelines.__dict__[model_name].get_model(dl_kwargs={"model_dir": partial_path})
+        else:
+            from huggingface_hub import snapshot_download
+            snapshot_download(model_name, local_dir=partial_path)
+        entry = {"kind": kind, "name": model_name, "language": name, "source": source}
+    else:
+        raise ValueError(f"Unknown model kind: {kind}")
+
+    shutil.rmtree(final_path, ignore_errors=True)
+    os.replace(partial_path, final_path)
+    entry.update({
+        "path": f"{kind}/{name}",
+        "files": _store_file_index(final_path),
+        "fetched_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    })
+    manifest = load_store_manifest()
+    manifest.setdefault("models", {})[key] = entry
+    save_store_manifest(manifest)
+    return entry
+
+def verify_store(quick=False):
+    """Kiểm tra từng file trong manifest: tồn tại, đúng kích thước, đúng sha256 (bỏ qua nếu quick)."""
+    report = {}
+    for key, entry in sorted(load_store_manifest().get("models", {}).items()):
+        base = os.path.join(MODEL_STORE_DIR, entry["path"])
+        problems = []
+        for rel, info in sorted(entry.get("files", {}).items()):
+            full = os.path.join(base, *rel.split("/"))
+            if not os.path.isfile(full):
+                problems.append(f"missing {rel}")
+            elif os.path.getsize(full) != info["bytes"]:
+                problems.append(f"size mismatch {rel}")
+            elif not quick and sha256_file(full) != info["sha256"]:
+                problems.append(f"checksum mismatch {rel}")
+        report[key] = problems
+    return report
+
+def load_whisper_model(model_size, device, compute_type, cpu_threads=None):
+    """Load WhisperX ASR model, fallback về CPU nếu GPU lỗi. Trả về (model, device, compute_type).
+    cpu_threads: số intra-op threads của CTranslate2 trên CPU (None = mặc định của whisperx)."""
+    thread_kwargs = {"threads": cpu_threads} if cpu_threads else {}
+    # Ưu tiên path trong model store (không cần network)
+    source = whisper_model_source(model_size)
     # Set env for ctranslate2 - ưu tiên GPU laptop
     os.environ.setdefault("CT2_COMPUTE_TYPE", compute_type)
     if device == "cuda":
@@ -97,7 +353,7 @@ def run_whisperx(audio_path, output_path="outputs/record.json", model_size="base
         if device == "cuda":
             try:
                 # Thử load với GPU
-                model = whisperx.load_model(model_size, device, compute_type=compute_type)
+                model = whisperx.load_model(source, device, compute_type=compute_type)
             except (RuntimeError, OSError) as gpu_err:
                 # Nếu lỗi CUDA (như cublas64_12.dll not found), fallback về CPU
                 error_str = str(gpu_err).lower()
@@ -105,18 +361,18 @@ def run_whisperx(audio_path, output_path="outputs/record.json", model_size="base
                     print(f"[whisperx] ⚠️  GPU error ({gpu_err}), falling back to CPU - transcribe_whisperx.py:99", flush=True)
                     print(f"[whisperx] 💡 Tip: Ensure CUDA 12.1 libraries are installed correctly - transcribe_whisperx.py:100", flush=True)
                     device = "cpu"
-                    compute_type = "float32"
+                    compute_type = cpu_compute_type(compute_type)
                     os.environ["CT2_COMPUTE_TYPE"] = compute_type
-                    model = whisperx.load_model(model_size, device, compute_type=compute_type)
+                    model = whisperx.load_model(source, device, compute_type=compute_type, **thread_kwargs)
                 else:
                     raise
         else:
             # CPU mode
             try:
-                model = whisperx.load_model(model_size, device, compute_type=compute_type)
+                model = whisperx.load_model(source, device, compute_type=compute_type, **thread_kwargs)
             except TypeError:
                 # older whisperx API may not accept compute_type param; rely on env var
-                model = whisperx.load_model(model_size, device)
+                model = whisperx.load_model(source, device)
     except Exception as e:
         error_str = str(e).lower()
         # Kiểm tra nếu là lỗi torchvision compatibility
@@ -132,34 +388,445 @@ def run_whisperx(audio_path, output_path="outputs/record.json", model_size="base
         # Nếu vẫn lỗi, thử không truyền compute_type
         print(f"[whisperx] ⚠️  Error loading model with compute_type, trying without: {e} - transcribe_whisperx.py:127", flush=True)
         try:
-            model = whisperx.load_model(model_size, device)
+            model = whisperx.load_model(source, device)
         except Exception as e2:
             print(f"[whisperx] ❌ Failed to load model: {e2} - transcribe_whisperx.py:130", flush=True)
             raise
 
-    # Transcribe (language optional)
-    # For English speaking practice, default to "en" if not specified
-    if not language:
-        language = "en"
-    result = model.transcribe(audio_path, language=language)
+    return model, device, compute_type
+
+def get_whisper_model(model_size="base", compute_type=None, cpu_threads=None):
+    """Lấy model từ cache trong process, chỉ load khi chưa có. Trả về (model, device, compute_type)."""
+    key = (model_size, compute_type, cpu_threads)
+    cached = _MODEL_CACHE.get(key)
+    if cached is not None:
+        _MODEL_CACHE.move_to_end(key)
+        return cached
+
+    device, resolved_compute_type = resolve_device(compute_type)
+    print(f"[whisperx] Loading model: {model_size} | Device: {device} | compute_type: {resolved_compute_type} - transcribe_whisperx.py:149", flush=True)
+    cached = load_whisper_model(model_size, device, resolved_compute_type, cpu_threads)
+    _MODEL_CACHE[key] = cached
+    _evict_whisper_models()
+    return cached
+
+def configure_model_cache(max_models=None):
+    """Thay đổi giới hạn số ASR model giữ trong process, evict ngay nếu vượt."""
+    global MODEL_CACHE_MAX_MODELS
+    if max_models is not None:
+        MODEL_CACHE_MAX_MODELS = max_models
+    _evict_whisper_models()
+
+def _evict_whisper_models():
+    # Luôn giữ lại model mới dùng gần nhất; caller đang giữ reference (vd. model nhỏ trong cascade) vẫn dùng tiếp được
+    evicted_cuda = False
+    while len(_MODEL_CACHE) > max(1, MODEL_CACHE_MAX_MODELS):
+        (model_size, _, cpu_threads), (_, device, compute_type) = _MODEL_CACHE.popitem(last=False)
+        evicted_cuda = evicted_cuda or device == "cuda"
+        print(f"[whisperx] Evicted model ({model_size}, {compute_type}, threads={cpu_threads}) from cache - transcribe_whisperx.py:160", flush=True)
+    if evicted_cuda:
+        torch.cuda.empty_cache()
+
+# CPU threading: profile do `tune-threads` đo trên máy này + budget threads cho từng job
+# (khi nhiều job chạy song song trên một host, mỗi job chỉ nên dùng phần cores của nó)
+THREAD_PROFILE_PATH = os.getenv("WHISPERX_THREAD_PROFILE", os.path.join("outputs", ".thread_profile.json"))
+THREAD_BUDGET = int(os.getenv("WHISPERX_THREADS", "0"))  # 0 = theo profile / mặc định thư viện
+_THREAD_PROFILE_CACHE = {}  # path -> (mtime, profile)
+
+def load_thread_profile():
+    """Profile đã tune, None nếu chưa có hoặc được đo trên máy có số cores khác."""
+    path = THREAD_PROFILE_PATH
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    cached = _THREAD_PROFILE_CACHE.get(path)
+    if cached is None or cached[0] != mtime:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                profile = json.load(f)
+        except (OSError, ValueError):
+            profile = None
+        if profile and profile.get("cpu_count") != os.cpu_count():
+            print(f"[whisperx] ⚠️  Thread profile was tuned for {profile.get('cpu_count')} CPUs, ignoring it - transcribe_whisperx.py:394", flush=True)
+            profile = None
+        cached = _THREAD_PROFILE_CACHE[path] = (mtime, profile)
+    return cached[1]
+
+def resolve_threads(budget=None):
+    """Cấu hình threads cho một job: {"cpu_threads", "num_workers", "torch_threads", "budget", "profile"}.
+    None = giữ mặc định của thư viện. budget (hoặc WHISPERX_THREADS) là trần tổng số threads của job."""
+    budget = budget or THREAD_BUDGET or None
+    profile = load_thread_profile()
+    cpu_threads = profile.get("cpu_threads") if profile else None
+    num_workers = profile.get("num_workers") if profile else None
+    if budget:
+        cpu_threads = min(cpu_threads, budget) if cpu_threads else budget
+        if num_workers:
+            # DataLoader workers là process riêng, chỉ giữ khi budget còn dư cores
+            num_workers = min(num_workers, budget - cpu_threads)
+    return {
+        "cpu_threads": cpu_threads,
+        "num_workers": num_workers,
+        "torch_threads": cpu_threads,
+        "budget": budget,
+        "profile": profile is not None,
+    }
+
+def apply_torch_threads(torch_threads):
+    # torch (VAD, align wav2vec2) mặc định dùng tất cả cores
+    if torch_threads and torch.get_num_threads() != torch_threads:
+        torch.set_num_threads(torch_threads)
+
+# Align models (wav2vec2) cache theo (language, device), LRU với giới hạn số model và bộ nhớ
+# key: (language_code, device) -> (align_model, metadata, size_bytes)
+_ALIGN_MODEL_CACHE = OrderedDict()
+_ALIGN_CACHE_LOCK = threading.Lock()
+# key -> threading.Event của lần load đang chạy, để preload và align không load trùng
+_ALIGN_LOADING = {}
+ALIGN_CACHE_MAX_MODELS = int(os.getenv("WHISPERX_ALIGN_CACHE_MAX_MODELS", "4"))
+ALIGN_CACHE_MAX_MB = float(os.getenv("WHISPERX_ALIGN_CACHE_MAX_MB", "2048"))
+
+def configure_align_cache(max_models=None, max_mb=None):
+    """Thay đổi giới hạn cache align model (dùng cho worker/batch), evict ngay nếu vượt."""
+    global ALIGN_CACHE_MAX_MODELS, ALIGN_CACHE_MAX_MB
+    if max_models is not None:
+        ALIGN_CACHE_MAX_MODELS = max_models
+    if max_mb is not None:
+        ALIGN_CACHE_MAX_MB = max_mb
+    with _ALIGN_CACHE_LOCK:
+        _evict_align_models()
+
+def _model_size_bytes(model):
+    try:
+        return sum(p.numel() * p.element_size() for p in model.parameters())
+    except Exception:
+        return 0
+
+def _evict_align_models():
+    # Gọi khi đang giữ _ALIGN_CACHE_LOCK; luôn giữ lại model mới dùng gần nhất
+    max_bytes = ALIGN_CACHE_MAX_MB * 1024 * 1024
+    total = sum(entry[2] for entry in _ALIGN_MODEL_CACHE.values())
+    evicted_cuda = False
+    while len(_ALIGN_MODEL_CACHE) > 1 and (len(_ALIGN_MODEL_CACHE) > ALIGN_CACHE_MAX_MODELS or total > max_bytes):
+        (language_code, device), (_, _, size) = _ALIGN_MODEL_CACHE.popitem(last=False)
+        total -= size
+        evicted_cuda = evicted_cuda or device == "cuda"
+        print(f"[whisperx] Evicted align model ({language_code}, {device}) from cache - transcribe_whisperx.py:186", flush=True)
+    if evicted_cuda:
+        torch.cuda.empty_cache()
+
+def get_align_model(language_code, device):
+    """Lấy (align_model, metadata) từ cache, chỉ load từ disk khi chưa có."""
+    key = (language_code, device)
+    while True:
+        with _ALIGN_CACHE_LOCK:
+            cached = _ALIGN_MODEL_CACHE.get(key)
+            if cached is not None:
+                _ALIGN_MODEL_CACHE.move_to_end(key)
+                return cached[0], cached[1]
+            pending = _ALIGN_LOADING.get(key)
+            if pending is None:
+                pending = _ALIGN_LOADING[key] = threading.Event()
+                break
+        # Thread khác đang load cùng key: chờ rồi đọc lại cache (load lỗi thì tự thử lại)
+        pending.wait()
+
+    try:
+        align_model, metadata = whisperx.load_align_model(language_code=language_code, device=device,
+                                                          **align_model_kwargs(language_code))
+        with _ALIGN_CACHE_LOCK:
+            _ALIGN_MODEL_CACHE[key] = (align_model, metadata, _model_size_bytes(align_model))
+            _ALIGN_MODEL_CACHE.move_to_end(key)
+            _evict_align_models()
+    finally:
+        with _ALIGN_CACHE_LOCK:
+            _ALIGN_LOADING.pop(key, None)
+        pending.set()
+    return align_model, metadata
+
+# Load align model trên background thread trong lúc transcribe (ngôn ngữ đã biết trước)
+ALIGN_PRELOAD = os.getenv("WHISPERX_ALIGN_PRELOAD", "1") != "0"
+
+class AlignPreloader:
+    def __init__(self, language_code, device):
+        self.language_code = language_code
+        self.device = device
+        self.seconds = None
+        self.error = None
+        self._thread = threading.Thread(target=self._run, name="align-preload", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        t0 = time.perf_counter()
+        try:
+            get_align_model(self.language_code, self.device)
+        except Exception as e:
+            # align_segments sẽ tự load lại và xử lý fallback như bình thường
+            self.error = e
+        finally:
+            self.seconds = time.perf_counter() - t0
+
+    def join(self):
+        self._thread.join()
+        return self
+
+# Transcript cache theo nội dung audio: sha256(audio bytes) + model_size + language + compute_type
+# Cache hit trả về output JSON đã lưu mà không cần load model
+TRANSCRIPT_CACHE_DIR = os.getenv("WHISPERX_CACHE_DIR", os.path.join("outputs", ".transcript_cache"))
+TRANSCRIPT_CACHE_MAX_MB = float(os.getenv("WHISPERX_CACHE_MAX_MB", "512"))  # 0 = tắt cache
+# Tăng mỗi khi shape của output (segments, words, noalign entry...) thay đổi: entry cũ tự bị bỏ qua
+CACHE_SCHEMA_VERSION = "2"
 
+def transcript_cache_key(audio_hash, model_size, language, compute_type, variant=None):
+    # variant: None = output đầy đủ (có align), "noalign" = chỉ có text/segments
+    parts = [CACHE_SCHEMA_VERSION, audio_hash, model_size, language or "en", compute_type or "auto"]
+    if variant:
+        parts.append(variant)
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+def _transcript_cache_path(key):
+    return os.path.join(TRANSCRIPT_CACHE_DIR, key[:2], f"{key}.json")
+
+def transcript_cache_get(key):
+    path = _transcript_cache_path(key)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            output = json.load(f)
+    except (OSError, ValueError):
+        return None
+    try:
+        # Cập nhật mtime để eviction theo thứ tự ít dùng gần đây nhất
+        os.utime(path, None)
+    except OSError:
+        pass
+    return output
+
+def transcript_cache_put(key, output):
+    path = _transcript_cache_path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(output, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        _evict_cache_dir(TRANSCRIPT_CACHE_DIR, TRANSCRIPT_CACHE_MAX_MB, ".json")
+    except OSError as e:
+        print(f"[whisperx] ⚠️  Could not write transcript cache: {e} - transcribe_whisperx.py:246", flush=True)
+
+def _evict_cache_dir(cache_dir, max_mb, suffix):
+    # Xóa các entry cũ nhất (theo mtime) cho tới khi tổng dung lượng <= max_mb
+    entries = []
+    for root, _, files in os.walk(cache_dir):
+        for name in files:
+            if not name.endswith(suffix):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+    max_bytes = max_mb * 1024 * 1024
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+# Audio chỉ decode (ffmpeg) một lần thành float32 16 kHz, dùng chung cho transcribe và align.
+# Nếu đặt WHISPERX_PCM_CACHE_DIR, PCM được lưu theo hash audio và lần sau memory-map thay vì decode lại
+PCM_CACHE_DIR = os.getenv("WHISPERX_PCM_CACHE_DIR")
+PCM_CACHE_MAX_MB = float(os.getenv("WHISPERX_PCM_CACHE_MAX_MB", "1024"))
+
+def load_waveform(audio_path, audio_hash=None):
+    """Trả về waveform float32 16 kHz mono (np.ndarray hoặc np.memmap)."""
+    import numpy as np
+
+    if not PCM_CACHE_DIR:
+        return whisperx.load_audio(audio_path)
+
+    pcm_path = os.path.join(PCM_CACHE_DIR, f"{audio_hash or sha256_file(audio_path)}.f32")
+    try:
+        if os.path.getsize(pcm_path) > 0:
+            os.utime(pcm_path, None)
+            # mode "c" (copy-on-write): đọc lazy từ disk, torch.from_numpy không cảnh báo read-only
+            return np.memmap(pcm_path, dtype=np.float32, mode="c")
+    except OSError:
+        pass
+
+    audio = whisperx.load_audio(audio_path)
+    try:
+        os.makedirs(PCM_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{pcm_path}.{os.getpid()}.tmp"
+        np.ascontiguousarray(audio, dtype=np.float32).tofile(tmp_path)
+        os.replace(tmp_path, pcm_path)
+        _evict_cache_dir(PCM_CACHE_DIR, PCM_CACHE_MAX_MB, ".f32")
+    except OSError as e:
+        print(f"[whisperx] ⚠️  Could not write PCM cache: {e} - transcribe_whisperx.py:363", flush=True)
+    return audio
+
+# legacy: words lặp lại trong từng segment["segment_words"], JSON indent=2 (FE đang đọc shape này)
+# compact: mỗi word lưu một lần, segment tham chiếu bằng index; JSON không indent
+# msgpack: cấu trúc compact, encode bằng msgpack
+OUTPUT_FORMATS = ["legacy", "compact", "msgpack"]
+DEFAULT_OUTPUT_FORMAT = os.getenv("WHISPERX_OUTPUT_FORMAT", "legacy")
+
+def _word_key(w):
+    return (w.get("start"), w.get("end"), w.get("word"))
+
+def compact_output(output):
+    """
+    Bỏ segment_words: segment có "word_range" [start, end) trỏ vào output["words"]
+    (hoặc "word_ids" nếu các word của segment không liên tiếp). Không sửa output gốc.
+    """
+    if output.get("format") == "compact":
+        return output
+    words = output.get("words") or []
+    # Khớp theo giá trị (không theo id) vì output từ cache là dict mới sau json.load
+    index = {}
+    for i, w in enumerate(words):
+        index.setdefault(_word_key(w), i)
+    segments = []
+    for seg in output.get("segments") or []:
+        seg = dict(seg)
+        seg_words = seg.pop("segment_words", None) or []
+        ids = [index[_word_key(w)] for w in seg_words if _word_key(w) in index]
+        if ids and len(ids) == len(seg_words) and ids == list(range(ids[0], ids[0] + len(ids))):
+            seg["word_range"] = [ids[0], ids[0] + len(ids)]
+        elif ids:
+            seg["word_ids"] = ids
+        segments.append(seg)
+    return {**output, "format": "compact", "segments": segments}
+
+def expand_compact_output(output):
+    """Ngược lại của compact_output: dựng lại segment_words cho code đọc shape legacy."""
+    if output.get("format") != "compact":
+        return output
+    words = output.get("words") or []
+    segments = []
+    for seg in output.get("segments") or []:
+        seg = dict(seg)
+        word_range = seg.pop("word_range", None)
+        word_ids = seg.pop("word_ids", None)
+        if words:
+            if word_range:
+                seg["segment_words"] = words[word_range[0]:word_range[1]]
+            else:
+                seg["segment_words"] = [words[i] for i in word_ids or []]
+        segments.append(seg)
+    expanded = {**output, "segments": segments}
+    expanded.pop("format")
+    return expanded
+
+def format_output(output, output_format=None):
+    output_format = output_format or DEFAULT_OUTPUT_FORMAT
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format} (expected one of {OUTPUT_FORMATS})")
+    return output if output_format == "legacy" else compact_output(output)
+
+def write_output(output, output_path, output_format=None):
+    output_format = output_format or DEFAULT_OUTPUT_FORMAT
+    if output_format == "msgpack":
+        if msgpack is None:
+            raise RuntimeError("msgpack chưa được cài: pip install msgpack (hoặc dùng --format compact)")
+        with open(output_path, "wb") as f:
+            f.write(msgpack.packb(compact_output(output), use_bin_type=True))
+    elif output_format == "compact":
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(compact_output(output), f, ensure_ascii=False, separators=(",", ":"))
+    else:
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(output, f, ensure_ascii=False, indent=2)
+    print(f"[whisperx] Saved result to: {output_path} - transcribe_whisperx.py:97", flush=True)
+
+# Đo thời gian từng stage + tài nguyên (peak RSS, số threads) cho mỗi lần transcribe
+class StageMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = OrderedDict()
+        self.info = {}
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = round(self.stages.get(name, 0.0) + time.perf_counter() - t0, 4)
+
+    def as_dict(self):
+        return {
+            "stages": dict(self.stages),
+            "total_seconds": round(time.perf_counter() - self.started, 4),
+            "peak_rss_mb": peak_rss_mb(),
+            "threads": {
+                "python": threading.active_count(),
+                "process": process_thread_count(),
+                # Cache hit không import torch: không ép import chỉ để đọc số threads
+                "torch_intra_op": torch.get_num_threads() if backends_loaded() else None,
+            },
+            **self.info,
+        }
+
+def stage(metrics, name):
+    return metrics.stage(name) if metrics is not None else nullcontext()
+
+def peak_rss_mb():
+    """Peak RSS của process hiện tại (MB), None nếu không đo được (Windows không có module resource)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux trả về KB, macOS trả về bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def process_thread_count():
+    """Số OS threads của process (gồm threads của CTranslate2/torch), None nếu không đọc được."""
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+def write_metrics(metrics, metrics_path):
+    with open(metrics_path, "w", encoding="utf-8") as f:
+        json.dump(metrics.as_dict(), f, ensure_ascii=False, indent=2)
+
+def default_metrics_path(output_path):
+    return f"{os.path.splitext(output_path)[0]}.metrics.json"
+
+def align_segments(segments, audio, detected_lang, device, metrics=None):
+    """Align words cho segments (audio: path hoặc waveform). Trả về (aligned_result, word_segments)."""
     # Align words - handle cases where alignment model doesn't exist for detected language
     # Sử dụng device hiện tại (có thể đã fallback về CPU)
-    detected_lang = result.get("language", language)
     aligned_result = None
     word_segments = []
     
     try:
-        align_model, metadata = whisperx.load_align_model(language_code=detected_lang, device=device)
-        aligned_result = whisperx.align(result["segments"], align_model, metadata, audio_path, device)
+        with stage(metrics, "align_model_load"):
+            align_model, metadata = get_align_model(detected_lang, device)
+        with stage(metrics, "align"):
+            aligned_result = whisperx.align(segments, align_model, metadata, audio, device)
         word_segments = aligned_result.get("word_segments") or []
     except (RuntimeError, OSError) as align_gpu_err:
         # Nếu lỗi CUDA khi align, thử fallback về CPU
         if ("cublas" in str(align_gpu_err).lower() or "cuda" in str(align_gpu_err).lower() or "dll" in str(align_gpu_err).lower()) and device == "cuda":
             print(f"[whisperx] ⚠️  GPU error during alignment ({align_gpu_err}), trying CPU - transcribe_whisperx.py:100", flush=True)
             try:
-                align_model, metadata = whisperx.load_align_model(language_code=detected_lang, device="cpu")
-                aligned_result = whisperx.align(result["segments"], align_model, metadata, audio_path, "cpu")
+                with stage(metrics, "align_model_load"):
+                    align_model, metadata = get_align_model(detected_lang, "cpu")
+                with stage(metrics, "align"):
+                    aligned_result = whisperx.align(segments, align_model, metadata, audio, "cpu")
                 word_segments = aligned_result.get("word_segments") or []
             except Exception as cpu_err:
                 print(f"[whisperx] ⚠️  CPU alignment also failed: {cpu_err}, continuing without alignment - transcribe_whisperx.py:105", flush=True)
@@ -170,8 +837,10 @@ def run_whisperx(audio_path, output_path="outputs/record.json", model_size="base
         if detected_lang != "en":
             print(f"[whisperx] Warning: No align-model for language '{detected_lang}', trying English fallback - transcribe_whisperx.py:69", flush=True)
             try:
-                align_model, metadata = whisperx.load_align_model(language_code="en", device=device)
-                aligned_result = whisperx.align(result["segments"], align_model, metadata, audio_path, device)
+                with stage(metrics, "align_model_load"):
+                    align_model, metadata = get_align_model("en", device)
+                with stage(metrics, "align"):
+                    aligned_result = whisperx.align(segments, align_model, metadata, audio, device)
                 word_segments = aligned_result.get("word_segments") or []
             except Exception as fallback_err:
                 print(f"[whisperx] Warning: Could not align with English fallback either: {fallback_err} - transcribe_whisperx.py:75", flush=True)
@@ -183,10 +852,229 @@ def run_whisperx(audio_path, output_path="outputs/record.json", model_size="base
         print(f"[whisperx] Warning: Alignment failed: {e}, continuing without alignment - transcribe_whisperx.py:81", flush=True)
         # Continue without alignment - still return transcription result
 
+    return aligned_result, word_segments
+
+def assign_words_to_segments(segments, words):
+    """
+    Gán seg["segment_words"] = các word có start >= seg.start và end <= seg.end.
+    Sort words theo start một lần rồi bisect cho mỗi segment: O((S + W) log W)
+    thay vì lọc toàn bộ words cho từng segment (O(S × W)).
+    """
+    timed = []
+    for w in words:
+        if not isinstance(w, dict):
+            continue
+        try:
+            start = float(w.get("start", -1))
+            end = float(w.get("end", -1))
+        except (TypeError, ValueError):
+            continue
+        timed.append((start, end, w))
+    # sort ổn định: words cùng start giữ nguyên thứ tự gốc
+    timed.sort(key=lambda item: item[0])
+    starts = [item[0] for item in timed]
+
+    for seg in segments:
+        s = float(seg.get("start", 0.0))
+        e = float(seg.get("end", s))
+        seg_words = []
+        i = bisect_left(starts, s)
+        while i < len(timed) and timed[i][0] <= e:
+            if timed[i][1] <= e:
+                seg_words.append(timed[i][2])
+            i += 1
+        seg["segment_words"] = seg_words
+    return segments
+
+# Bỏ qua align cho clip ngắn hơn ngưỡng này (giây) khi caller không cần word timings; 0 = tắt
+SKIP_ALIGN_BELOW_SECONDS = float(os.getenv("WHISPERX_SKIP_ALIGN_BELOW_S", "0"))
+
+def should_align(align, word_timings, audio_seconds, skip_below=None):
+    """align: True/False ép buộc; None = tự quyết theo độ dài clip và nhu cầu word timings."""
+    if align is not None:
+        return bool(align)
+    if word_timings:
+        return True
+    threshold = SKIP_ALIGN_BELOW_SECONDS if skip_below is None else skip_below
+    return not (threshold > 0 and audio_seconds < threshold)
+
+# Cascade: model nhỏ chạy trước, chỉ segment kém tin cậy mới chạy lại bằng model lớn
+CASCADE_LOGPROB_THRESHOLD = float(os.getenv("WHISPERX_CASCADE_LOGPROB", "-0.7"))
+CASCADE_NO_SPEECH_THRESHOLD = float(os.getenv("WHISPERX_CASCADE_NO_SPEECH", "0.6"))
+CASCADE_PAD_SECONDS = 0.2  # nới biên slice audio khi chạy lại segment
+
+def needs_escalation(avg_logprob, no_speech_prob, logprob_threshold=None, no_speech_threshold=None):
+    logprob_threshold = CASCADE_LOGPROB_THRESHOLD if logprob_threshold is None else logprob_threshold
+    no_speech_threshold = CASCADE_NO_SPEECH_THRESHOLD if no_speech_threshold is None else no_speech_threshold
+    return avg_logprob < logprob_threshold or no_speech_prob > no_speech_threshold
+
+def transcribe_cascade(model, audio, language, escalation_model, compute_type=None, batch_size=None,
+                       logprob_threshold=None, no_speech_threshold=None, cpu_threads=None):
+    """
+    Pass 1 dùng backend faster-whisper của pipeline (model.model) để có avg_logprob /
+    no_speech_prob cho từng segment. Segment không đạt ngưỡng được transcribe lại trên
+    slice audio của nó bằng escalation_model (chỉ load khi thực sự cần).
+    Trả về dict giống model.transcribe() kèm "cascade" mô tả các segment đã escalate.
+    """
+    asr = getattr(model, "model", None)
+    if asr is None or not hasattr(asr, "transcribe"):
+        # Pipeline không lộ backend faster-whisper: không có confidence, dùng thẳng model lớn
+        print("[whisperx] Warning: cascade needs faster-whisper confidences, using escalation model directly - transcribe_whisperx.py:560", flush=True)
+        big, _, _ = get_whisper_model(escalation_model, compute_type, cpu_threads)
+        kwargs = {"language": language}
+        if batch_size:
+            kwargs["batch_size"] = batch_size
+        result = big.transcribe(audio, **kwargs)
+        result["cascade"] = {"escalation_model": escalation_model, "escalated": list(range(len(result.get("segments") or []))), "first_pass": False}
+        return result
+
+    fw_segments, _info = asr.transcribe(audio, language=language, beam_size=1, vad_filter=True,
+                                        condition_on_previous_text=False)
+    escalate_kwargs = {"language": language}
+    if batch_size:
+        escalate_kwargs["batch_size"] = batch_size
+    big = None
+    segments, escalated = [], []
+    for seg in fw_segments:
+        item = {
+            "text": seg.text,
+            "start": round(float(seg.start), 3),
+            "end": round(float(seg.end), 3),
+            "avg_logprob": round(float(seg.avg_logprob), 4),
+            "no_speech_prob": round(float(seg.no_speech_prob), 4),
+            "escalated": False,
+        }
+        if needs_escalation(item["avg_logprob"], item["no_speech_prob"], logprob_threshold, no_speech_threshold):
+            if big is None:
+                big, _, _ = get_whisper_model(escalation_model, compute_type, cpu_threads)
+            s = max(0, int((item["start"] - CASCADE_PAD_SECONDS) * STREAM_SAMPLE_RATE))
+            e = min(len(audio), int((item["end"] + CASCADE_PAD_SECONDS) * STREAM_SAMPLE_RATE))
+            if e > s:
+                sub = big.transcribe(audio[s:e], **escalate_kwargs)
+                text = " ".join((x.get("text") or "").strip() for x in sub.get("segments") or [] if (x.get("text") or "").strip())
+                if text:
+                    item["text"] = " " + text
+                    item["escalated"] = True
+                    escalated.append(len(segments))
+        segments.append(item)
+
+    print(f"[whisperx] Cascade: escalated {len(escalated)}/{len(segments)} segments to {escalation_model} - transcribe_whisperx.py:600", flush=True)
+    return {
+        "language": language,
+        "segments": segments,
+        "cascade": {"escalation_model": escalation_model, "escalated": escalated, "first_pass": True},
+    }
+
+def run_whisperx(audio_path, output_path="outputs/record.json", model_size="base", language=None, compute_type=None, batch_size=None, use_cache=True, metrics=None,
+                 align=None, word_timings=False, skip_align_below=None, escalation_model=None, threads=None,
+                 output_format=None):
+    """
+    metrics: StageMetrics tùy chọn, được điền thời gian từng stage của lần chạy này.
+    escalation_model: bật cascade — model_size (tiny/base) chạy trước, segment kém tin cậy
+    được chạy lại bằng model này; output có thêm "cascade" liệt kê index các segment đã escalate.
+    align: True = luôn align, False = bỏ qua align + language tagging (chỉ trả text/segments),
+    None = tự động bỏ qua cho clip ngắn hơn skip_align_below nếu word_timings=False.
+    threads: budget threads của job (khi chạy trong pool), None = theo profile / WHISPERX_THREADS.
+    output_format: "legacy" | "compact" | "msgpack" (mặc định WHISPERX_OUTPUT_FORMAT); cache luôn lưu legacy.
+    """
+    if not os.path.exists(audio_path):
+        raise FileNotFoundError(f"Không tìm thấy file audio: {audio_path}")
+
+    out_dir = os.path.dirname(output_path) or "."
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Cache hit: trả kết quả đã lưu, không load model / không chạy torch
+    audio_hash = None
+    cached_output = None
+    # Key theo tham số được yêu cầu (trước khi compute_type/language được resolve)
+    cache_params = (f"{model_size}>{escalation_model}" if escalation_model else model_size, language, compute_type)
+    if use_cache and TRANSCRIPT_CACHE_MAX_MB > 0:
+        with stage(metrics, "cache_lookup"):
+            audio_hash = sha256_file(audio_path)
+            # Output có align đáp ứng được cả request chỉ cần text
+            variants = [None] if (align or word_timings) else [None, "noalign"]
+            for variant in variants:
+                entry = transcript_cache_get(transcript_cache_key(audio_hash, *cache_params, variant))
+                if entry is None:
+                    continue
+                if variant == "noalign":
+                    # Entry chỉ có text: hợp lệ khi caller tắt align, hoặc policy tự động cũng bỏ qua align cho clip này
+                    entry_seconds = entry.pop("audio_seconds", None)
+                    if align is not False and (entry_seconds is None or
+                                               should_align(align, word_timings, entry_seconds, skip_align_below)):
+                        continue
+                cached_output = entry
+                break
+        if cached_output is not None:
+            print(f"[whisperx] Transcript cache hit: {audio_hash[:12]} - transcribe_whisperx.py:311", flush=True)
+            with stage(metrics, "json_write"):
+                write_output(cached_output, output_path, output_format)
+            if metrics is not None:
+                metrics.info["cache_hit"] = True
+            return format_output(cached_output, output_format)
+
+    # Model được giữ lại giữa các lần gọi trong cùng process (xem serve_main)
+    # Thời gian import whisperx/torch chỉ xuất hiện ở job đầu tiên của process
+    if not backends_loaded():
+        with stage(metrics, "import"):
+            load_backends()
+    thread_config = resolve_threads(threads)
+    apply_torch_threads(thread_config["torch_threads"])
+    # _MODEL_CACHE key theo compute_type được yêu cầu: escalation model cũng dùng giá trị này
+    requested_compute_type = compute_type
+    with stage(metrics, "model_load"):
+        model, device, compute_type = get_whisper_model(model_size, compute_type, thread_config["cpu_threads"])
+
+    print(f"[whisperx] Running on: {audio_path} - transcribe_whisperx.py:65", flush=True)
+    print(f"[whisperx] Model: {model_size} | Device: {device} | compute_type: {compute_type} - transcribe_whisperx.py:66", flush=True)
+
+    # Transcribe (language optional)
+    # For English speaking practice, default to "en" if not specified
+    if not language:
+        language = "en"
+    transcribe_kwargs = {"language": language}
+    if batch_size:
+        # Số VAD segments được decode cùng lúc (batched inference của WhisperX)
+        transcribe_kwargs["batch_size"] = batch_size
+    if thread_config["num_workers"] is not None:
+        transcribe_kwargs["num_workers"] = thread_config["num_workers"]
+    # Decode một lần, cùng waveform cho transcribe, align và CPU retry của align
+    with stage(metrics, "audio_decode"):
+        audio = load_waveform(audio_path, audio_hash)
+    audio_seconds = len(audio) / STREAM_SAMPLE_RATE
+    do_align = should_align(align, word_timings, audio_seconds, skip_align_below)
+    # Ngôn ngữ đã biết (mặc định "en") nên align model load song song với transcribe
+    preloader = AlignPreloader(language, device) if do_align and ALIGN_PRELOAD else None
+    with stage(metrics, "transcribe"):
+        if escalation_model:
+            result = transcribe_cascade(model, audio, language, escalation_model, requested_compute_type, batch_size,
+                                        cpu_threads=thread_config["cpu_threads"])
+        else:
+            result = model.transcribe(audio, **transcribe_kwargs)
+
+    detected_lang = result.get("language", language)
+    aligned_result, word_segments = None, []
+    if do_align:
+        aligned_result, word_segments = align_segments(result["segments"], audio, detected_lang, device, metrics)
+    else:
+        # Fast path: không load align model, không align, không tag ngôn ngữ theo từ
+        print(f"[whisperx] Skipping alignment ({audio_seconds:.1f}s clip) - transcribe_whisperx.py:608", flush=True)
+    if preloader is not None and metrics is not None:
+        # align_model_load lúc này chỉ còn thời gian chờ preload xong
+        preloader.join()
+        waited = metrics.stages.get("align_model_load", 0.0)
+        metrics.info["align_preload"] = {
+            "language": preloader.language_code,
+            "load_seconds": round(preloader.seconds, 4),
+            "waited_seconds": waited,
+            "saved_seconds": round(max(0.0, preloader.seconds - waited), 4),
+        }
+
     # Attach language per word (use word_segments from alignment if available)
     if not word_segments and aligned_result:
         word_segments = aligned_result.get("word_segments") or []
-    words_with_lang = detect_language_per_word(word_segments)
+    with stage(metrics, "language_tagging"):
+        words_with_lang = detect_language_per_word(word_segments)
 
     # Build segments with words grouped per segment for FE "conversation view"
     # WhisperX returns segment-level start/end; words have their own start/end.
@@ -194,11 +1082,7 @@ def run_whisperx(audio_path, output_path="outputs/record.json", model_size="base
     segments = result.get("segments") or []
     if segments and words_with_lang:
         # Gán words vào mỗi segment theo khoảng thời gian
-        for seg in segments:
-            s = float(seg.get("start", 0.0))
-            e = float(seg.get("end", s))
-            seg_words = [w for w in words_with_lang if isinstance(w, dict) and float(w.get("start", -1)) >= s and float(w.get("end", -1)) <= e]
-            seg["segment_words"] = seg_words
+        assign_words_to_segments(segments, words_with_lang)
 
     # Extract full text from segments
     full_text = " ".join([seg.get("text", "") for seg in segments if seg.get("text")])
@@ -207,29 +1091,1073 @@ def run_whisperx(audio_path, output_path="outputs/record.json", model_size="base
         "language": result.get("language"),
         "text": full_text,
         "segments": segments,
-        "words": words_with_lang
+        "words": words_with_lang,
+        "aligned": do_align
     }
+    if result.get("cascade"):
+        output["cascade"] = result["cascade"]
+    if words_with_lang:
+        with stage(metrics, "pronunciation"):
+            output["pronunciation"] = compute_pronunciation_metrics(segments, words_with_lang)
 
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(output, f, ensure_ascii=False, indent=2)
+    with stage(metrics, "json_write"):
+        write_output(output, output_path, output_format)
+    if audio_hash:
+        if do_align:
+            transcript_cache_put(transcript_cache_key(audio_hash, *cache_params), output)
+        else:
+            # Lưu độ dài clip để lần sau policy tự động quyết định được entry text-only có dùng được không
+            transcript_cache_put(transcript_cache_key(audio_hash, *cache_params, "noalign"),
+                                 {**output, "audio_seconds": round(audio_seconds, 3)})
+    if metrics is not None:
+        metrics.info.update({
+            "cache_hit": False,
+            "device": device,
+            "compute_type": compute_type,
+            "model": model_size,
+            "escalation_model": escalation_model,
+            "thread_config": thread_config,
+            "escalated_segments": len((result.get("cascade") or {}).get("escalated") or []),
+            "audio_seconds": round(audio_seconds, 3),
+            "rtf": round((time.perf_counter() - metrics.started) / audio_seconds, 4) if audio_seconds else None,
+        })
+    return format_output(output, output_format)
 
-    print(f"[whisperx] Saved result to: {output_path} - transcribe_whisperx.py:97", flush=True)
-    return output
+# Chấm phát âm / độ trôi chảy cục bộ từ score của alignment (không cần gọi LLM)
+LOW_CONFIDENCE_SCORE = float(os.getenv("WHISPERX_LOW_CONFIDENCE_SCORE", "0.5"))
+PAUSE_SECONDS = 0.25       # khoảng lặng giữa hai từ được tính là pause
+LONG_PAUSE_SECONDS = 1.0   # pause dài (ngập ngừng)
+
+def _mean(values):
+    return sum(values) / len(values) if values else None
+
+def compute_pronunciation_metrics(segments, words, low_score=None):
+    """
+    Tổng hợp score của từng word sau align thành metrics per-word, per-segment và overall.
+    Gắn thêm w["pause_before"] và w["low_confidence"] vào các word có timing/score.
+    Điểm số theo thang 0-10 giống quick_analysis.
+    """
+    low_score = LOW_CONFIDENCE_SCORE if low_score is None else low_score
+    timed = [w for w in words if isinstance(w, dict) and isinstance(w.get("start"), (int, float)) and isinstance(w.get("end"), (int, float))]
+    scores = [w["score"] for w in words if isinstance(w, dict) and isinstance(w.get("score"), (int, float))]
+
+    pauses = []
+    previous_end = None
+    for w in timed:
+        if previous_end is not None:
+            gap = max(0.0, w["start"] - previous_end)
+            w["pause_before"] = round(gap, 3)
+            if gap >= PAUSE_SECONDS:
+                pauses.append(gap)
+        previous_end = w["end"]
+    low_confidence = []
+    for index, w in enumerate(words):
+        if isinstance(w, dict) and isinstance(w.get("score"), (int, float)):
+            w["low_confidence"] = w["score"] < low_score
+            if w["low_confidence"]:
+                low_confidence.append({"index": index, "word": w.get("word"), "score": round(w["score"], 3)})
+
+    span = (timed[-1]["end"] - timed[0]["start"]) if timed else 0.0
+    speaking_time = sum(w["end"] - w["start"] for w in timed)
+    speech_rate = len(timed) / span * 60 if span > 0 else None
+    articulation_rate = len(timed) / speaking_time * 60 if speaking_time > 0 else None
+    long_pauses = [p for p in pauses if p >= LONG_PAUSE_SECONDS]
+
+    segment_metrics = []
+    for index, seg in enumerate(segments):
+        seg_words = seg.get("segment_words") or []
+        seg_scores = [w["score"] for w in seg_words if isinstance(w, dict) and isinstance(w.get("score"), (int, float))]
+        duration = float(seg.get("end", 0.0)) - float(seg.get("start", 0.0))
+        segment_metrics.append({
+            "index": index,
+            "start": seg.get("start"),
+            "end": seg.get("end"),
+            "words": len(seg_words),
+            "mean_score": round(_mean(seg_scores), 4) if seg_scores else None,
+            "low_confidence_words": sum(1 for s in seg_scores if s < low_score),
+            "speech_rate_wpm": round(len(seg_words) / duration * 60, 1) if duration > 0 and seg_words else None,
+        })
+
+    pronunciation_score = None
+    if scores:
+        pronunciation_score = round(_mean(scores) * 10, 1)
+    fluency_score = None
+    if speech_rate is not None:
+        # Tốc độ tự nhiên khoảng 80-180 từ/phút; trừ điểm khi quá chậm/quá nhanh và khi ngập ngừng nhiều
+        penalty = 0.0
+        if speech_rate < 80:
+            penalty += min(4.0, (80 - speech_rate) / 10)
+        elif speech_rate > 180:
+            penalty += min(2.0, (speech_rate - 180) / 20)
+        minutes = span / 60 if span > 0 else 1.0
+        penalty += min(4.0, len(long_pauses) / max(minutes, 1 / 6))
+        fluency_score = round(max(0.0, 10.0 - penalty), 1)
+    parts = [s for s in (pronunciation_score, fluency_score) if s is not None]
+    overall = round(0.6 * pronunciation_score + 0.4 * fluency_score, 1) if len(parts) == 2 else (parts[0] if parts else None)
+
+    return {
+        "score": overall,
+        "pronunciation_score": pronunciation_score,
+        "fluency_score": fluency_score,
+        "mean_word_score": round(_mean(scores), 4) if scores else None,
+        "min_word_score": round(min(scores), 4) if scores else None,
+        "scored_words": len(scores),
+        "unscored_words": len(words) - len(scores),
+        "low_confidence_threshold": low_score,
+        "low_confidence_words": low_confidence,
+        "speech_rate_wpm": round(speech_rate, 1) if speech_rate is not None else None,
+        "articulation_rate_wpm": round(articulation_rate, 1) if articulation_rate is not None else None,
+        "pauses": {
+            "count": len(pauses),
+            "long_count": len(long_pauses),
+            "total_seconds": round(sum(pauses), 3),
+            "longest_seconds": round(max(pauses), 3) if pauses else 0.0,
+            "mean_seconds": round(_mean(pauses), 3) if pauses else 0.0,
+        },
+        "segments": segment_metrics,
+    }
+
+def run_forced_alignment(audio_path, expected_text, output_path="outputs/record.json", language=None, metrics=None,
+                         output_format=None):
+    """
+    Read-aloud mode: không chạy Whisper, chỉ CTC forced alignment của expected_text với audio
+    bằng wav2vec2 align model. Trả về timing + score cho từng từ của câu mẫu.
+    output_format: "legacy" | "compact" | "msgpack" (mặc định WHISPERX_OUTPUT_FORMAT), như run_whisperx.
+    """
+    if not os.path.exists(audio_path):
+        raise FileNotFoundError(f"Không tìm thấy file audio: {audio_path}")
+    expected_text = (expected_text or "").strip()
+    if not expected_text:
+        raise ValueError("expected_text rỗng")
+
+    out_dir = os.path.dirname(output_path) or "."
+    os.makedirs(out_dir, exist_ok=True)
+    language = language or "en"
+    if not backends_loaded():
+        with stage(metrics, "import"):
+            load_backends()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    with stage(metrics, "audio_decode"):
+        audio = load_waveform(audio_path)
+    audio_seconds = len(audio) / STREAM_SAMPLE_RATE
+    print(f"[whisperx] Forced alignment on: {audio_path} ({audio_seconds:.1f}s) - transcribe_whisperx.py:671", flush=True)
+
+    # Toàn bộ câu mẫu là một segment phủ hết audio; CTC tự tìm vị trí từng ký tự
+    segments = [{"text": expected_text, "start": 0.0, "end": audio_seconds}]
+    aligned_result, word_segments = align_segments(segments, audio, language, device, metrics)
+
+    aligned_segments = (aligned_result or {}).get("segments") or []
+    for seg in aligned_segments:
+        seg["segment_words"] = seg.pop("words", None) or []
+        seg.pop("chars", None)
+    with stage(metrics, "language_tagging"):
+        words = detect_language_per_word(word_segments)
+
+    scores = [w["score"] for w in words if isinstance(w.get("score"), (int, float))]
+    output = {
+        "mode": "forced_alignment",
+        "language": language,
+        "text": expected_text,
+        "segments": aligned_segments or segments,
+        "words": words,
+        "aligned": bool(aligned_segments),
+        "alignment_score": round(sum(scores) / len(scores), 4) if scores else None,
+        "unaligned_words": sum(1 for w in words if "start" not in w),
+    }
+    if words:
+        output["pronunciation"] = compute_pronunciation_metrics(output["segments"], words)
+
+    with stage(metrics, "json_write"):
+        write_output(output, output_path, output_format)
+    if metrics is not None:
+        metrics.info.update({"mode": "forced_alignment", "device": device, "audio_seconds": round(audio_seconds, 3)})
+    return format_output(output, output_format)
+
+# Streaming mode: audio 16 kHz được chia thành các chunk cắt tại khoảng lặng,
+# mỗi chunk được transcribe + align ngay và từng segment được emit dạng JSON line
+STREAM_SAMPLE_RATE = 16000
+
+def find_chunk_boundaries(audio, sample_rate=STREAM_SAMPLE_RATE, chunk_seconds=30.0, search_seconds=5.0, frame_seconds=0.02):
+    """
+    Trả về list (start_sample, end_sample). Mỗi chunk dài tối đa chunk_seconds,
+    điểm cắt là frame có năng lượng thấp nhất (khoảng lặng) trong search_seconds cuối chunk.
+    """
+    import numpy as np
+
+    total = len(audio)
+    chunk = int(chunk_seconds * sample_rate)
+    search = int(min(search_seconds, chunk_seconds / 2) * sample_rate)
+    frame = max(1, int(frame_seconds * sample_rate))
+
+    boundaries = []
+    start = 0
+    while start < total:
+        if start + chunk >= total:
+            boundaries.append((start, total))
+            break
+        end = _silence_cut(audio, start, chunk, search, frame)
+        boundaries.append((start, end))
+        start = end
+    return boundaries
+
+def _silence_cut(audio, start, chunk, search, frame):
+    # Điểm cắt của chunk bắt đầu tại start: giữa frame năng lượng thấp nhất trong search samples cuối
+    import numpy as np
+
+    end = start + chunk
+    window = np.asarray(audio[end - search:end], dtype=np.float32)
+    n_frames = len(window) // frame
+    if n_frames > 0:
+        energy = np.square(window[:n_frames * frame].reshape(n_frames, frame)).mean(axis=1)
+        end = end - search + int(np.argmin(energy)) * frame + frame // 2
+    return end
+
+def iter_audio_chunks(blocks, sample_rate=STREAM_SAMPLE_RATE, chunk_seconds=30.0, search_seconds=5.0, frame_seconds=0.02):
+    """
+    Như find_chunk_boundaries nhưng trên luồng block (xem iter_pcm_blocks): yield (start_sample, chunk_audio)
+    ngay khi đủ dữ liệu. Chỉ chunk hiện tại + một block đọc trước nằm trong bộ nhớ.
+    """
+    import numpy as np
+
+    chunk = int(chunk_seconds * sample_rate)
+    search = int(min(search_seconds, chunk_seconds / 2) * sample_rate)
+    frame = max(1, int(frame_seconds * sample_rate))
+
+    buffer = np.zeros(0, dtype=np.float32)
+    start = 0
+    for block in blocks:
+        buffer = np.concatenate([buffer, block])
+        # Còn nhiều hơn một chunk thì chắc chắn phải cắt, không cần biết tổng độ dài
+        while len(buffer) > chunk:
+            cut = _silence_cut(buffer, 0, chunk, search, frame)
+            yield start, buffer[:cut]
+            start += cut
+            buffer = buffer[cut:]
+    if len(buffer):
+        yield start, buffer
+
+def iter_pcm_blocks(audio_path, block_samples=STREAM_SAMPLE_RATE * 5):
+    """
+    Waveform float32 16 kHz mono theo từng block, decode dần qua ffmpeg pipe (cùng lệnh với whisperx.load_audio)
+    thay vì decode cả file vào RAM. Nếu PCM cache đã có file này thì đọc từng block từ memmap.
+    """
+    import subprocess
+    import numpy as np
+
+    if PCM_CACHE_DIR:
+        pcm_path = os.path.join(PCM_CACHE_DIR, f"{sha256_file(audio_path)}.f32")
+        if os.path.exists(pcm_path) and os.path.getsize(pcm_path) > 0:
+            pcm = np.memmap(pcm_path, dtype=np.float32, mode="r")
+            for start in range(0, len(pcm), block_samples):
+                yield np.array(pcm[start:start + block_samples])
+            return
+
+    cmd = ["ffmpeg", "-nostdin", "-threads", "0", "-loglevel", "error", "-i", audio_path,
+           "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(STREAM_SAMPLE_RATE), "-"]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    completed = False
+    try:
+        while True:
+            data = proc.stdout.read(block_samples * 2)
+            if not data:
+                break
+            usable = len(data) - len(data) % 2
+            yield np.frombuffer(data[:usable], np.int16).astype(np.float32) / 32768.0
+        completed = True
+    finally:
+        if not completed and proc.poll() is None:
+            # Consumer dừng sớm (lỗi transcribe, client ngắt): không để ffmpeg chạy tiếp
+            proc.kill()
+        proc.stdout.close()
+        stderr = proc.stderr.read()
+        proc.stderr.close()
+        returncode = proc.wait()
+    if returncode != 0:
+        raise RuntimeError(f"Failed to load audio: {stderr.decode('utf-8', errors='replace').strip()}")
+
+def _offset_times(item, offset):
+    for key in ("start", "end"):
+        if isinstance(item.get(key), (int, float)):
+            item[key] = round(item[key] + offset, 3)
+
+def run_whisperx_stream(audio_path, emit, model_size="base", language=None, compute_type=None, batch_size=None, chunk_seconds=30.0,
+                        threads=None):
+    """
+    Transcribe audio theo từng chunk, gọi emit(record) cho mỗi segment đã hoàn tất (kèm words).
+    Audio được decode dần, chỉ chunk hiện tại + một block đọc trước nằm trong bộ nhớ
+    (không phụ thuộc độ dài recording). Trả về record tổng kết cuối cùng.
+    """
+    if not os.path.exists(audio_path):
+        raise FileNotFoundError(f"Không tìm thấy file audio: {audio_path}")
+
+    thread_config = resolve_threads(threads)
+    apply_torch_threads(thread_config["torch_threads"])
+    model, device, compute_type = get_whisper_model(model_size, compute_type, thread_config["cpu_threads"])
+    if not language:
+        language = "en"
+
+    print(f"[whisperx] Streaming {audio_path} in chunks of <= {chunk_seconds:g}s - transcribe_whisperx.py:420", flush=True)
+
+    transcribe_kwargs = {"language": language}
+    if batch_size:
+        transcribe_kwargs["batch_size"] = batch_size
+
+    segment_index = 0
+    word_count = 0
+    total_samples = 0
+    chunks = iter_audio_chunks(iter_pcm_blocks(audio_path), chunk_seconds=chunk_seconds)
+    for chunk_index, (start, chunk_audio) in enumerate(chunks):
+        total_samples = start + len(chunk_audio)
+        offset = start / STREAM_SAMPLE_RATE
+        result = model.transcribe(chunk_audio, **transcribe_kwargs)
+        segments = result.get("segments") or []
+        if not segments:
+            continue
+
+        aligned_result, _ = align_segments(segments, chunk_audio, result.get("language", language), device)
+        if aligned_result and aligned_result.get("segments"):
+            segments = aligned_result["segments"]
+
+        for seg in segments:
+            words = detect_language_per_word([w for w in (seg.pop("words", None) or []) if isinstance(w, dict)])
+            for w in words:
+                _offset_times(w, offset)
+            _offset_times(seg, offset)
+            seg.pop("chars", None)
+            seg["segment_words"] = words
+            emit({"type": "segment", "index": segment_index, "chunk": chunk_index, **seg})
+            segment_index += 1
+            word_count += len(words)
+
+    return {
+        "type": "done",
+        "language": language,
+        "segments": segment_index,
+        "words": word_count,
+        "duration": round(total_samples / STREAM_SAMPLE_RATE, 3),
+    }
+
+def stream_to_stdout(audio_path, output_path=None, **kwargs):
+    """Emit JSON lines ra stdout (và ghi song song vào output_path nếu có), log chuyển sang stderr."""
+    protocol_out = sys.stdout
+    sys.stdout = sys.stderr
+    out_file = None
+    if output_path:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        out_file = open(output_path, "w", encoding="utf-8")
+
+    def emit(record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        protocol_out.write(line)
+        protocol_out.flush()
+        if out_file:
+            out_file.write(line)
+
+    try:
+        summary = run_whisperx_stream(audio_path, emit, **kwargs)
+        emit(summary)
+        return summary
+    finally:
+        if out_file:
+            out_file.close()
+        sys.stdout = protocol_out
+
+def default_output_path(input_path, output_format=None):
+    ext = ".msgpack" if (output_format or DEFAULT_OUTPUT_FORMAT) == "msgpack" else ".json"
+    return os.path.join("outputs", f"{os.path.splitext(os.path.basename(input_path))[0]}{ext}")
+
+def handle_job(job, defaults=None):
+    """Chạy một job của worker. job: {"id", "input", "output"?, "model"?, "lang"?, "compute_type"?}"""
+    defaults = defaults or {}
+    if not isinstance(job, dict):
+        # Dòng JSON hợp lệ nhưng không phải object (vd. [1]) không được làm chết serve loop
+        return {"id": None, "ok": False, "error": "Job phải là JSON object"}
+    job_id = job.get("id")
+    try:
+        input_path = job.get("input")
+        if not input_path:
+            raise ValueError("Job thiếu trường 'input'")
+        output_format = job.get("format") or defaults.get("format")
+        output_path = job.get("output") or default_output_path(input_path, output_format)
+        metrics = StageMetrics() if job.get("metrics") else None
+        if job.get("expected_text"):
+            output = run_forced_alignment(input_path, job["expected_text"], output_path=output_path,
+                                          language=job.get("lang") or defaults.get("lang"), metrics=metrics,
+                                          output_format=output_format)
+            response = {"id": job_id, "ok": True, "output_path": output_path, "result": output}
+            if metrics is not None:
+                response["metrics"] = metrics.as_dict()
+            return response
+        output = run_whisperx(
+            input_path,
+            output_path=output_path,
+            model_size=job.get("model") or defaults.get("model", "base"),
+            language=job.get("lang") or defaults.get("lang"),
+            compute_type=job.get("compute_type") or defaults.get("compute_type"),
+            batch_size=job.get("batch_size"),
+            use_cache=job.get("cache", True),
+            metrics=metrics,
+            align=job.get("align"),
+            word_timings=job.get("word_timings", False),
+            escalation_model=job.get("cascade_model") or defaults.get("cascade_model"),
+            threads=job.get("threads") or defaults.get("threads"),
+            output_format=output_format,
+        )
+        response = {"id": job_id, "ok": True, "output_path": output_path, "result": output}
+        if metrics is not None:
+            response["metrics"] = metrics.as_dict()
+        return response
+    except Exception as e:
+        traceback.print_exc(file=sys.stderr)
+        return {"id": job_id, "ok": False, "error": str(e)}
+
+def _serve_stdin(defaults, out):
+    # Mỗi dòng stdin là một job JSON, mỗi dòng stdout là một response JSON
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            response = {"id": None, "ok": False, "error": f"Invalid JSON: {e}"}
+        else:
+            response = handle_job(job, defaults)
+        out.write(json.dumps(response, ensure_ascii=False) + "\n")
+        out.flush()
+
+def _serve_socket(socket_path, defaults):
+    import socketserver
+    import threading
+
+    if not hasattr(socketserver, "UnixStreamServer"):
+        raise RuntimeError("Unix socket không được hỗ trợ trên hệ điều hành này, hãy dùng stdin mode")
+
+    # Model không thread-safe: các job từ nhiều connection được chạy lần lượt
+    job_lock = threading.Lock()
+
+    class JobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for raw in self.rfile:
+                line = raw.decode("utf-8").strip()
+                if not line:
+                    continue
+                try:
+                    job = json.loads(line)
+                except ValueError as e:
+                    response = {"id": None, "ok": False, "error": f"Invalid JSON: {e}"}
+                else:
+                    with job_lock:
+                        response = handle_job(job, defaults)
+                self.wfile.write((json.dumps(response, ensure_ascii=False) + "\n").encode("utf-8"))
+                self.wfile.flush()
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with Server(socket_path, JobHandler) as server:
+        print(f"[whisperx] Worker listening on {socket_path} - transcribe_whisperx.py:317", flush=True)
+        try:
+            server.serve_forever()
+        finally:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+
+def serve_main(argv):
+    """Worker mode: load model một lần, nhận job qua stdin (JSON lines) hoặc Unix socket."""
+    parser = argparse.ArgumentParser(prog="transcribe_whisperx.py serve", description="Long-lived WhisperX worker that keeps models loaded between jobs.")
+    parser.add_argument("--socket", default=None, help="Unix socket path. If omitted, read jobs from stdin as JSON lines.")
+    parser.add_argument("--model", "-m", default="base", help="Default Whisper model size, preloaded at startup")
+    parser.add_argument("--lang", "-l", default=None, help="Default language code for jobs without 'lang'")
+    parser.add_argument("--compute-type", default=None, choices=COMPUTE_TYPES, help="Default compute type (auto-detect if omitted)")
+    parser.add_argument("--align-cache-models", type=int, default=None, help="Max align models kept in memory (env WHISPERX_ALIGN_CACHE_MAX_MODELS, default 4)")
+    parser.add_argument("--align-cache-mb", type=float, default=None, help="Memory cap for cached align models in MB (env WHISPERX_ALIGN_CACHE_MAX_MB, default 2048)")
+    parser.add_argument("--model-cache-models", type=int, default=None, help="Max Whisper models kept in memory (env WHISPERX_MODEL_CACHE_MAX_MODELS, default 2)")
+    parser.add_argument("--cascade", nargs="?", const="small", default=None, metavar="MODEL",
+                        help="Default escalation model for jobs without 'cascade_model' (first pass uses --model)")
+    parser.add_argument("--threads", type=int, default=None, help="Thread budget per job (env WHISPERX_THREADS, default: tuned profile)")
+    parser.add_argument("--format", default=None, choices=OUTPUT_FORMATS, help="Default output format for jobs without 'format' (env WHISPERX_OUTPUT_FORMAT, default legacy)")
+    args = parser.parse_args(argv)
+
+    configure_align_cache(args.align_cache_models, args.align_cache_mb)
+    configure_model_cache(args.model_cache_models)
+
+    defaults = {"model": args.model, "lang": args.lang, "compute_type": args.compute_type, "cascade_model": args.cascade,
+                "threads": args.threads, "format": args.format}
+
+    # stdout dành cho protocol; mọi log print() trong lúc chạy job chuyển sang stderr
+    protocol_out = sys.stdout
+    sys.stdout = sys.stderr
+
+    get_whisper_model(args.model, args.compute_type, resolve_threads(args.threads)["cpu_threads"])
+    ready = {"event": "ready", "model": args.model, "pid": os.getpid(),
+             "import_seconds": round(IMPORT_SECONDS, 4) if IMPORT_SECONDS is not None else None}
+
+    try:
+        if args.socket:
+            protocol_out.write(json.dumps(dict(ready, socket=args.socket)) + "\n")
+            protocol_out.flush()
+            _serve_socket(args.socket, defaults)
+        else:
+            protocol_out.write(json.dumps(ready) + "\n")
+            protocol_out.flush()
+            _serve_stdin(defaults, protocol_out)
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
+
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".m4a", ".webm", ".ogg", ".flac", ".mp4", ".aac")
+
+def collect_batch_inputs(paths, output_dir="outputs"):
+    """
+    Chuyển danh sách paths thành list (input_path, output_path).
+    Mỗi path có thể là: thư mục (lấy mọi file audio bên trong), manifest .txt (mỗi dòng một path),
+    manifest .json/.jsonl (string path hoặc {"input", "output"}), hoặc một file audio.
+    Output tự đặt là output_dir/<tên file>.json; các input trùng tên (a/clip.wav và b/clip.wav,
+    clip.wav và clip.mp3) được giữ đường dẫn tương đối / đuôi file để không ghi đè lên nhau.
+    """
+    entries = []
+
+    def add(input_path, output_path=None):
+        entries.append((input_path, output_path))
+
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(AUDIO_EXTENSIONS):
+                    add(os.path.join(path, name))
+        elif path.lower().endswith(".txt"):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        add(line)
+        elif path.lower().endswith((".json", ".jsonl")):
+            with open(path, "r", encoding="utf-8") as f:
+                if path.lower().endswith(".jsonl"):
+                    items = [json.loads(line) for line in f if line.strip()]
+                else:
+                    items = json.load(f)
+            for item in items:
+                if isinstance(item, dict):
+                    add(item.get("input"), item.get("output"))
+                else:
+                    add(item)
+        else:
+            add(path)
+    return _assign_batch_outputs(entries, output_dir)
+
+def _assign_batch_outputs(entries, output_dir):
+    def default_name(input_path):
+        return os.path.join(output_dir, f"{os.path.splitext(os.path.basename(input_path))[0]}.json")
+
+    # Nhóm các input (khác nhau) sẽ ghi cùng một output; output do manifest chỉ định được giữ nguyên
+    groups = {}
+    for input_path, output_path in entries:
+        key = os.path.normpath(output_path or default_name(input_path))
+        groups.setdefault(key, set()).add(os.path.abspath(input_path))
+
+    renamed = {}
+    for key, inputs in groups.items():
+        if len(inputs) < 2:
+            continue
+        # Giữ thư mục tương đối so với thư mục chung của các input trùng tên
+        base = os.path.commonpath([os.path.dirname(p) for p in inputs])
+        rel_paths = {p: os.path.relpath(p, base) for p in inputs}
+        stems = Counter(os.path.splitext(rel)[0] for rel in rel_paths.values())
+        for p, rel in rel_paths.items():
+            stem = os.path.splitext(rel)[0]
+            # clip.wav và clip.mp3 cùng thư mục: giữ cả đuôi file trong tên output
+            renamed[p] = os.path.join(output_dir, f"{rel if stems[stem] > 1 else stem}.json")
+
+    assigned, owners = [], {}
+    for input_path, output_path in entries:
+        if not output_path:
+            output_path = renamed.get(os.path.abspath(input_path)) or default_name(input_path)
+        owner = owners.setdefault(os.path.normpath(output_path), os.path.abspath(input_path))
+        if owner != os.path.abspath(input_path):
+            raise ValueError(f"Output trùng nhau: {input_path} và {owner} cùng ghi ra {output_path}")
+        assigned.append((input_path, output_path))
+    return assigned
+
+def transcribe_batch(entries, model_size="base", language=None, compute_type=None, batch_size=16, use_cache=True, align=None, threads=None,
+                     output_format=None):
+    """Transcribe nhiều file với một model đã load, mỗi input ghi ra một JSON riêng."""
+    results = []
+    for index, (input_path, output_path) in enumerate(entries, 1):
+        print(f"[whisperx] Batch {index}/{len(entries)}: {input_path} - transcribe_whisperx.py:405", flush=True)
+        if (output_format or DEFAULT_OUTPUT_FORMAT) == "msgpack":
+            output_path = os.path.splitext(output_path)[0] + ".msgpack"
+        try:
+            run_whisperx(input_path, output_path=output_path, model_size=model_size, language=language,
+                         compute_type=compute_type, batch_size=batch_size, use_cache=use_cache, align=align, threads=threads,
+                         output_format=output_format)
+            results.append({"input": input_path, "output": output_path, "ok": True})
+        except Exception as e:
+            print(f"[whisperx] ⚠️  Batch item failed: {input_path}: {e} - transcribe_whisperx.py:411", file=sys.stderr, flush=True)
+            results.append({"input": input_path, "output": output_path, "ok": False, "error": str(e)})
+    return results
+
+def batch_main(argv):
+    """Batch mode: transcribe nhiều recordings trong một process (load model một lần)."""
+    parser = argparse.ArgumentParser(prog="transcribe_whisperx.py batch", description="Transcribe many recordings with one loaded WhisperX model.")
+    parser.add_argument("inputs", nargs="+", help="Audio files, directories, or manifest files (.txt/.json/.jsonl)")
+    parser.add_argument("--output-dir", "-d", default="outputs", help="Directory for per-input JSON outputs (default: outputs)")
+    parser.add_argument("--model", "-m", default="base", help="Whisper model size (tiny, base, small, medium, large)")
+    parser.add_argument("--lang", "-l", default=None, help="Language code (e.g., en, vi). If omitted, auto-detect.")
+    parser.add_argument("--compute-type", default=None, choices=COMPUTE_TYPES, help="Compute type (auto-detect: float16 for GPU, WHISPERX_CPU_COMPUTE_TYPE or float32 for CPU)")
+    parser.add_argument("--batch-size", type=int, default=16, help="Number of VAD segments decoded together (default: 16)")
+    parser.add_argument("--summary", default=None, help="Optional path to write a JSON summary of all items")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the content-addressed transcript cache")
+    parser.add_argument("--no-align", action="store_true", help="Skip word alignment and per-word language tagging (text/segments only)")
+    parser.add_argument("--threads", type=int, default=None, help="Thread budget (env WHISPERX_THREADS, default: tuned profile)")
+    parser.add_argument("--format", default=None, choices=OUTPUT_FORMATS, help="Output format (env WHISPERX_OUTPUT_FORMAT, default legacy)")
+    args = parser.parse_args(argv)
+
+    entries = collect_batch_inputs(args.inputs, output_dir=args.output_dir)
+    if not entries:
+        print("[whisperx] No input audio found for batch - transcribe_whisperx.py:428", file=sys.stderr)
+        sys.exit(1)
+
+    results = transcribe_batch(entries, model_size=args.model, language=args.lang,
+                               compute_type=args.compute_type, batch_size=args.batch_size, use_cache=not args.no_cache,
+                               align=False if args.no_align else None, threads=args.threads, output_format=args.format)
+    failed = [r for r in results if not r["ok"]]
+    print(f"[whisperx] Batch done: {len(results) - len(failed)} ok, {len(failed)} failed - transcribe_whisperx.py:434", flush=True)
+
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    sys.exit(2 if failed else 0)
+
+def _assign_words_to_segments_naive(segments, words):
+    # Cách cũ (O(segments × words)), chỉ giữ lại để so sánh trong bench-grouping
+    for seg in segments:
+        s = float(seg.get("start", 0.0))
+        e = float(seg.get("end", s))
+        seg["segment_words"] = [w for w in words if isinstance(w, dict) and float(w.get("start", -1)) >= s and float(w.get("end", -1)) <= e]
+    return segments
+
+def _synthetic_transcript(minutes, words_per_second=2.5, segment_seconds=6.0):
+    duration = minutes * 60.0
+    words = []
+    t = 0.0
+    step = 1.0 / words_per_second
+    while t + 0.3 <= duration:
+        words.append({"word": "word", "start": round(t, 3), "end": round(t + 0.3, 3), "score": 0.9})
+        t += step
+    segments = []
+    s = 0.0
+    while s < duration:
+        segments.append({"text": "", "start": s, "end": min(s + segment_seconds, duration)})
+        s += segment_seconds
+    return segments, words
+
+def bench_grouping_main(argv):
+    """Micro-benchmark: gán words vào segments, cách cũ (quadratic) vs sorted sweep."""
+    parser = argparse.ArgumentParser(prog="transcribe_whisperx.py bench-grouping", description="Benchmark word-to-segment grouping on synthetic transcripts.")
+    parser.add_argument("--minutes", type=float, nargs="+", default=[5, 15, 30, 60], help="Synthetic recording lengths in minutes (default: 5 15 30 60)")
+    parser.add_argument("--words-per-second", type=float, default=2.5, help="Speech rate of the synthetic word list (default: 2.5)")
+    parser.add_argument("--segment-seconds", type=float, default=6.0, help="Segment length (default: 6)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per size, best time is reported (default: 3)")
+    args = parser.parse_args(argv)
+
+    print(f"{'minutes':>8} {'segments':>9} {'words':>7} {'naive_ms':>10} {'sweep_ms':>10} {'speedup':>8}")
+    for minutes in args.minutes:
+        segments, words = _synthetic_transcript(minutes, args.words_per_second, args.segment_seconds)
+        timings = {}
+        grouped = {}
+        for name, fn in (("naive", _assign_words_to_segments_naive), ("sweep", assign_words_to_segments)):
+            best = None
+            for _ in range(max(1, args.repeat)):
+                segs = [dict(seg) for seg in segments]
+                t0 = time.perf_counter()
+                fn(segs, words)
+                elapsed = time.perf_counter() - t0
+                best = elapsed if best is None else min(best, elapsed)
+            timings[name] = best
+            grouped[name] = [[id(w) for w in seg["segment_words"]] for seg in segs]
+        if grouped["naive"] != grouped["sweep"]:
+            print(f"[whisperx] ❌ Grouping mismatch at {minutes} minutes - transcribe_whisperx.py:788", file=sys.stderr)
+            sys.exit(1)
+        speedup = timings["naive"] / timings["sweep"] if timings["sweep"] > 0 else float("inf")
+        print(f"{minutes:>8g} {len(segments):>9} {len(words):>7} {timings['naive'] * 1000:>10.2f} {timings['sweep'] * 1000:>10.2f} {speedup:>7.1f}x")
+    sys.exit(0)
+
+def _normalized_words(output):
+    words = [w.get("word", "") for w in output.get("words") or [] if isinstance(w, dict)]
+    if not words:
+        words = (output.get("text") or "").split()
+    normalized = [_EDGE_PUNCT_RE.sub("", w.strip().lower()) for w in words]
+    return [w for w in normalized if w]
+
+def word_agreement(reference, hypothesis):
+    """Tỉ lệ từ khớp (theo thứ tự) giữa hai output, 1.0 = giống hệt."""
+    from difflib import SequenceMatcher
+
+    ref = _normalized_words(reference)
+    hyp = _normalized_words(hypothesis)
+    if not ref and not hyp:
+        return 1.0
+    matches = sum(block.size for block in SequenceMatcher(None, ref, hyp, autojunk=False).get_matching_blocks())
+    return round(matches / max(len(ref), len(hyp)), 4)
+
+def bench_compute_run_main(argv):
+    # Chạy trong process con của bench-compute để peak RSS của mỗi compute type được đo riêng
+    import tempfile
+
+    parser = argparse.ArgumentParser(prog="transcribe_whisperx.py _bench-compute-run")
+    parser.add_argument("clips", nargs="+")
+    parser.add_argument("--model", default="base")
+    parser.add_argument("--lang", default=None)
+    parser.add_argument("--compute-type", required=True, choices=COMPUTE_TYPES)
+    args = parser.parse_args(argv)
+
+    protocol_out = sys.stdout
+    sys.stdout = sys.stderr
+
+    t0 = time.perf_counter()
+    # Cùng cpu_threads với run_whisperx để các clip dùng lại đúng model này (không load bản thứ hai)
+    _, device, compute_type = get_whisper_model(args.model, args.compute_type, resolve_threads()["cpu_threads"])
+    load_seconds = time.perf_counter() - t0
+
+    clips = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for index, clip in enumerate(args.clips):
+            t0 = time.perf_counter()
+            output = run_whisperx(clip, output_path=os.path.join(tmp_dir, f"{index}.json"), model_size=args.model,
+                                  language=args.lang, compute_type=args.compute_type, use_cache=False)
+            seconds = time.perf_counter() - t0
+            duration = len(load_waveform(clip)) / STREAM_SAMPLE_RATE
+            clips.append({"clip": clip, "seconds": round(seconds, 3), "duration": round(duration, 3), "output": output})
+
+    report = {
+        "compute_type": compute_type,
+        "device": device,
+        "model_load_seconds": round(load_seconds, 3),
+        "peak_rss_mb": peak_rss_mb(),
+        "clips": clips,
+    }
+    protocol_out.write(json.dumps(report, ensure_ascii=False) + "\n")
+    protocol_out.flush()
+    sys.exit(0)
+
+def bench_compute_main(argv):
+    """Benchmark cùng một bộ clips với từng compute type: real-time factor, peak RSS, word agreement với float32."""
+    import subprocess
+
+    parser = argparse.ArgumentParser(prog="transcribe_whisperx.py bench-compute", description="Compare compute types (e.g. float32 vs int8) on the same clips.")
+    parser.add_argument("clips", nargs="+", help="Audio clips to transcribe under each compute type")
+    parser.add_argument("--model", "-m", default="base", help="Whisper model size (default: base)")
+    parser.add_argument("--lang", "-l", default=None, help="Language code (default: en)")
+    parser.add_argument("--compute-types", nargs="+", default=["float32", "int8_float32", "int8"], choices=COMPUTE_TYPES,
+                        help="Compute types to compare; float32 is always run as the reference")
+    parser.add_argument("--report", default=None, help="Optional path to write the full JSON report")
+    args = parser.parse_args(argv)
+
+    compute_types = ["float32"] + [ct for ct in args.compute_types if ct != "float32"]
+    runs = {}
+    for compute_type in compute_types:
+        print(f"[whisperx] Benchmarking compute_type={compute_type} on {len(args.clips)} clip(s) - transcribe_whisperx.py:976", file=sys.stderr, flush=True)
+        cmd = [sys.executable, os.path.abspath(__file__), "_bench-compute-run", *args.clips,
+               "--model", args.model, "--compute-type", compute_type]
+        if args.lang:
+            cmd += ["--lang", args.lang]
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding="utf-8")
+        if proc.returncode != 0:
+            print(f"[whisperx] ❌ compute_type={compute_type} failed:\n{proc.stderr[-2000:]} - transcribe_whisperx.py:983", file=sys.stderr, flush=True)
+            continue
+        runs[compute_type] = json.loads(proc.stdout.strip().splitlines()[-1])
+
+    reference = runs.get("float32")
+    summary = []
+    for compute_type, run in runs.items():
+        total_seconds = sum(c["seconds"] for c in run["clips"])
+        total_duration = sum(c["duration"] for c in run["clips"])
+        agreements = []
+        if reference:
+            agreements = [word_agreement(ref["output"], c["output"]) for ref, c in zip(reference["clips"], run["clips"])]
+        summary.append({
+            "compute_type": run["compute_type"],
+            "requested_compute_type": compute_type,
+            "device": run["device"],
+            "model_load_seconds": run["model_load_seconds"],
+            "rtf": round(total_seconds / total_duration, 4) if total_duration else None,
+            "peak_rss_mb": run["peak_rss_mb"],
+            "word_agreement": round(sum(agreements) / len(agreements), 4) if agreements else None,
+        })
+
+    print(f"{'compute_type':>14} {'device':>6} {'load_s':>7} {'rtf':>7} {'peak_rss_mb':>12} {'agreement':>10}")
+    for row in summary:
+        rtf = f"{row['rtf']:.3f}" if row["rtf"] is not None else "-"
+        agreement = f"{row['word_agreement']:.3f}" if row["word_agreement"] is not None else "-"
+        print(f"{row['requested_compute_type']:>14} {row['device']:>6} {row['model_load_seconds']:>7.2f} {rtf:>7} {str(row['peak_rss_mb']):>12} {agreement:>10}")
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump({"model": args.model, "clips": args.clips, "summary": summary, "runs": runs}, f, ensure_ascii=False, indent=2)
+    sys.exit(0 if runs else 2)
+
+def tune_threads_main(argv):
+    """Đo RTF trên CPU cho các tổ hợp (cpu_threads, num_workers) và lưu thread profile."""
+    cpu_count = os.cpu_count() or 1
+    default_threads = sorted({t for t in (1, 2, 4, 8, 16, 32) if t <= cpu_count} | {cpu_count})
+    parser = argparse.ArgumentParser(prog="transcribe_whisperx.py tune-threads",
+                                     description="Benchmark CPU thread/worker combinations on this machine and save a thread profile.")
+    parser.add_argument("clip", help="Representative audio clip")
+    parser.add_argument("--model", "-m", default="base", help="Whisper model size (default: base)")
+    parser.add_argument("--lang", "-l", default="en", help="Language code (default: en)")
+    parser.add_argument("--compute-type", default=None, choices=COMPUTE_TYPES, help="CPU compute type (default: WHISPERX_CPU_COMPUTE_TYPE or float32)")
+    parser.add_argument("--threads", type=int, nargs="+", default=default_threads, help=f"cpu_threads candidates (default: {default_threads})")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2], help="num_workers candidates (default: 0 2)")
+    parser.add_argument("--repeat", type=int, default=2, help="Runs per combination, best one counts (default: 2)")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Pick the fewest threads within this fraction of the best RTF (default: 0.1)")
+    parser.add_argument("--profile", default=THREAD_PROFILE_PATH, help=f"Where to save the profile (default: {THREAD_PROFILE_PATH})")
+    args = parser.parse_args(argv)
+
+    compute_type = cpu_compute_type(args.compute_type)
+    audio = load_waveform(args.clip)
+    audio_seconds = len(audio) / STREAM_SAMPLE_RATE
+    results = []
+    for cpu_threads in args.threads:
+        apply_torch_threads(cpu_threads)
+        model, _, _ = load_whisper_model(args.model, "cpu", compute_type, cpu_threads)
+        # Warm-up: lần đầu có chi phí khởi tạo không liên quan tới số threads
+        model.transcribe(audio, language=args.lang)
+        for num_workers in args.workers:
+            best = None
+            for _ in range(max(1, args.repeat)):
+                t0 = time.perf_counter()
+                model.transcribe(audio, language=args.lang, num_workers=num_workers)
+                elapsed = time.perf_counter() - t0
+                best = elapsed if best is None else min(best, elapsed)
+            row = {"cpu_threads": cpu_threads, "num_workers": num_workers, "seconds": round(best, 4),
+                   "rtf": round(best / audio_seconds, 4) if audio_seconds else None}
+            results.append(row)
+            print(f"[whisperx] threads={cpu_threads:<3} workers={num_workers:<2} {best:.2f}s rtf={row['rtf']} - transcribe_whisperx.py:1497", flush=True)
+        del model
+
+    # Số threads ít nhất mà vẫn gần nhanh nhất: phần cores còn lại dành cho job song song khác
+    fastest = min(row["seconds"] for row in results)
+    chosen = min((row for row in results if row["seconds"] <= fastest * (1 + args.tolerance)),
+                 key=lambda row: (row["cpu_threads"], row["num_workers"], row["seconds"]))
+    profile = {
+        "cpu_count": cpu_count,
+        "cpu_threads": chosen["cpu_threads"],
+        "num_workers": chosen["num_workers"],
+        "torch_threads": chosen["cpu_threads"],
+        "max_parallel_jobs": max(1, cpu_count // chosen["cpu_threads"]),
+        "model": args.model,
+        "compute_type": compute_type,
+        "clip": args.clip,
+        "audio_seconds": round(audio_seconds, 3),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(args.profile) or ".", exist_ok=True)
+    tmp_path = f"{args.profile}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(profile, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, args.profile)
+    print(f"[whisperx] Saved thread profile to {args.profile}: cpu_threads={profile['cpu_threads']} "
+          f"num_workers={profile['num_workers']} max_parallel_jobs={profile['max_parallel_jobs']} - transcribe_whisperx.py:1524", flush=True)
+    sys.exit(0)
+
+def models_main(argv):
+    global MODEL_STORE_DIR
+    parser = argparse.ArgumentParser(prog="transcribe_whisperx.py models",
+                                     description="Manage the offline model store (Whisper CTranslate2 + wav2vec2 align models).")
+    parser.add_argument("--store", default=None, help="Store directory (env WHISPERX_MODEL_STORE, default models/whisperx)")
+    sub = parser.add_subparsers(dest="action", required=True)
+    prefetch = sub.add_parser("prefetch", help="Download models into the store and record checksums")
+    prefetch.add_argument("--whisper", nargs="*", default=["base"], metavar="SIZE", help="Whisper model sizes (default: base)")
+    prefetch.add_argument("--align", nargs="*", default=["en"], metavar="LANG", help="Align model languages (default: en)")
+    prefetch.add_argument("--force", action="store_true", help="Re-download models already in the store")
+    verify = sub.add_parser("verify", help="Check every file in the manifest against its checksum")
+    verify.add_argument("--quick", action="store_true", help="Only check presence and size, skip sha256")
+    sub.add_parser("list", help="Print the manifest entries")
+    args = parser.parse_args(argv)
+    if args.store:
+        MODEL_STORE_DIR = args.store
+
+    if args.action == "prefetch":
+        failed = []
+        for kind, names in (("whisper", args.whisper), ("align", args.align)):
+            for name in names:
+                try:
+                    prefetch_model(kind, name, force=args.force)
+                except Exception as e:
+                    print(f"[whisperx] ❌ Prefetch {kind}/{name} failed: {e} - transcribe_whisperx.py:1478", flush=True)
+                    failed.append(f"{kind}/{name}")
+        sys.exit(1 if failed else 0)
+
+    if args.action == "verify":
+        report = verify_store(quick=args.quick)
+        for key, problems in report.items():
+            print(f"{key}: {'OK' if not problems else '; '.join(problems)}")
+        if not report:
+            print(f"Model store is empty: {MODEL_STORE_DIR}")
+        sys.exit(1 if any(report.values()) else 0)
+
+    for key, entry in sorted(load_store_manifest().get("models", {}).items()):
+        size_mb = sum(info["bytes"] for info in entry.get("files", {}).values()) / (1024 * 1024)
+        print(f"{key:<20} {entry.get('name', ''):<40} {size_mb:>9.1f} MB  {entry.get('fetched_at', '')}")
+    sys.exit(0)
+
+# Startup budget cho các path rẻ (--help, input không tồn tại, cache hit): không được import backend nặng
+STARTUP_BUDGET_SECONDS = float(os.getenv("WHISPERX_STARTUP_BUDGET_S", "1.0"))
+HEAVY_MODULES = ("whisperx", "torch", "torchaudio", "ctranslate2", "faster_whisper", "transformers", "pyannote")
+
+def _measure_startup(cli_args, env=None):
+    import subprocess
+    cmd = [sys.executable, "-X", "importtime", os.path.abspath(__file__), *cli_args]
+    started = time.perf_counter()
+    proc = subprocess.run(cmd, capture_output=True, text=True, encoding="utf-8", errors="replace", env=env, timeout=300)
+    wall_seconds = time.perf_counter() - started
+    heavy, import_us = set(), 0
+    for line in proc.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package"
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        try:
+            self_us = int(parts[0])
+        except (ValueError, IndexError):
+            continue  # dòng header
+        import_us += self_us
+        top = parts[2].strip().split(".")[0]
+        if top in HEAVY_MODULES:
+            heavy.add(top)
+    return {"returncode": proc.returncode, "wall_seconds": round(wall_seconds, 3),
+            "import_seconds": round(import_us / 1e6, 3), "heavy_modules": sorted(heavy)}
+
+def check_startup_main(argv):
+    """Regression check: CLI startup của các path rẻ phải nằm trong budget và không import whisperx/torch."""
+    import tempfile
+
+    global TRANSCRIPT_CACHE_DIR
+    parser = argparse.ArgumentParser(prog="transcribe_whisperx.py check-startup",
+                                     description="Check that cheap CLI paths start within a time budget without importing whisperx/torch.")
+    parser.add_argument("--budget", type=float, default=STARTUP_BUDGET_SECONDS,
+                        help=f"Max wall seconds per case (env WHISPERX_STARTUP_BUDGET_S, default {STARTUP_BUDGET_SECONDS})")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case, fastest one counts (default: 3)")
+    parser.add_argument("--report", default=None, help="Optional path to write the results as JSON")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Cache hit: file "audio" giả + entry cache tương ứng trong cache dir tạm
+        audio_path = os.path.join(tmp_dir, "clip.wav")
+        with open(audio_path, "wb") as f:
+            f.write(os.urandom(4096))
+        TRANSCRIPT_CACHE_DIR = os.path.join(tmp_dir, "cache")
+        cached = {"language": "en", "text": "cached", "segments": [], "words": [], "aligned": True}
+        transcript_cache_put(transcript_cache_key(sha256_file(audio_path), "base", None, None), cached)
+        env = {**os.environ, "WHISPERX_CACHE_DIR": TRANSCRIPT_CACHE_DIR, "PYTHONIOENCODING": "utf-8"}
+
+        cases = [
+            ("help", ["--help"], True),
+            ("missing_input", [os.path.join(tmp_dir, "missing.wav"), "-o", os.path.join(tmp_dir, "missing.json")], False),
+            ("cache_hit", [audio_path, "-o", os.path.join(tmp_dir, "out.json")], True),
+        ]
+        results = []
+        for name, cli_args, expect_ok in cases:
+            runs = [_measure_startup(cli_args, env) for _ in range(max(1, args.repeat))]
+            best = min(runs, key=lambda run: run["wall_seconds"])
+            problems = []
+            if (best["returncode"] == 0) != expect_ok:
+                problems.append(f"exit code {best['returncode']}")
+            if best["heavy_modules"]:
+                problems.append(f"imported {', '.join(best['heavy_modules'])}")
+            if best["wall_seconds"] > args.budget:
+                problems.append(f"{best['wall_seconds']:.2f}s > budget {args.budget:.2f}s")
+            results.append({"case": name, **best, "ok": not problems, "problems": problems})
+
+    print(f"{'case':<14} {'wall_s':>7} {'import_s':>9}  result")
+    for row in results:
+        status = "OK" if row["ok"] else "FAIL: " + "; ".join(row["problems"])
+        print(f"{row['case']:<14} {row['wall_seconds']:>7.3f} {row['import_seconds']:>9.3f}  {status}")
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump({"budget_seconds": args.budget, "results": results}, f, ensure_ascii=False, indent=2)
+    sys.exit(0 if all(row["ok"] for row in results) else 1)
+
+# Sub-commands: transcribe_whisperx.py <command> [args...]
+# Không có command -> giữ nguyên CLI cũ: transcribe_whisperx.py <audio_path> [options]
+COMMANDS = {
+    "serve": serve_main,
+    "batch": batch_main,
+    "bench-grouping": bench_grouping_main,
+    "bench-compute": bench_compute_main,
+    "models": models_main,
+    "tune-threads": tune_threads_main,
+    "check-startup": check_startup_main,
+    "_bench-compute-run": bench_compute_run_main,
+}
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
+
     parser = argparse.ArgumentParser(description="Transcribe audio with WhisperX and produce JSON output.")
     parser.add_argument("input", help="Path to input audio file")
     parser.add_argument("--output", "-o", help="Path to output JSON file (default: outputs/<basename>.json)")
     parser.add_argument("--model", "-m", default="base", help="Whisper model size (tiny, base, small, medium, large)")
     parser.add_argument("--lang", "-l", default=None, help="Language code (e.g., en, vi). If omitted, auto-detect.")
-    parser.add_argument("--compute-type", default=None, choices=["float16","float32"], help="Compute type (auto-detect: float16 for GPU, float32 for CPU)")
+    parser.add_argument("--compute-type", default=None, choices=COMPUTE_TYPES, help="Compute type (auto-detect: float16 for GPU, WHISPERX_CPU_COMPUTE_TYPE or float32 for CPU)")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the content-addressed transcript cache")
+    parser.add_argument("--stream", action="store_true", help="Emit finalized segments as JSON lines on stdout while transcribing (output file becomes JSONL)")
+    parser.add_argument("--chunk-seconds", type=float, default=30.0, help="Max chunk length for --stream, cut at the quietest point (default: 30)")
+    parser.add_argument("--no-align", action="store_true", help="Skip word alignment and per-word language tagging (text/segments only)")
+    parser.add_argument("--expected-text", default=None, help="Read-aloud mode: skip ASR and force-align this text against the audio")
+    parser.add_argument("--expected-file", default=None, help="Like --expected-text, reading the text from a UTF-8 file")
+    parser.add_argument("--word-timings", action="store_true", help="Caller needs word timings: never auto-skip alignment")
+    parser.add_argument("--skip-align-below", type=float, default=None, metavar="SECONDS",
+                        help="Auto-skip alignment for clips shorter than this unless --word-timings (env WHISPERX_SKIP_ALIGN_BELOW_S, default 0 = off)")
+    parser.add_argument("--threads", type=int, default=None, help="Thread budget for this job (env WHISPERX_THREADS, default: tuned profile)")
+    parser.add_argument("--format", default=None, choices=OUTPUT_FORMATS,
+                        help="legacy (segment_words, indented), compact (word index ranges, no indent) or msgpack (env WHISPERX_OUTPUT_FORMAT, default legacy)")
+    parser.add_argument("--cascade", nargs="?", const="small", default=None, metavar="MODEL",
+                        help="Transcribe with --model first (use tiny/base) and re-run low-confidence segments with MODEL (default: small)")
+    parser.add_argument("--metrics", nargs="?", const="", default=None, metavar="PATH",
+                        help="Write per-stage timing, peak RSS and thread counts to a sidecar JSON (default: <output>.metrics.json)")
     args = parser.parse_args()
 
     input_path = args.input
-    output_path = args.output if args.output else os.path.join("outputs", f"{os.path.splitext(os.path.basename(input_path))[0]}.json")
+    if args.stream:
+        try:
+            stream_to_stdout(input_path, output_path=args.output, model_size=args.model, language=args.lang,
+                             compute_type=args.compute_type, chunk_seconds=args.chunk_seconds, threads=args.threads)
+            sys.exit(0)
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            print(f"[whisperx] Failed: {str(e)} - transcribe_whisperx.py:118", file=sys.stderr)
+            sys.exit(2)
+
+    output_path = args.output if args.output else default_output_path(input_path, args.format)
+
+    expected_text = args.expected_text
+    if args.expected_file:
+        with open(args.expected_file, "r", encoding="utf-8") as f:
+            expected_text = f.read()
 
     try:
-        run_whisperx(input_path, output_path=output_path, model_size=args.model, language=args.lang, compute_type=args.compute_type)
+        metrics = StageMetrics() if args.metrics is not None else None
+        if expected_text is not None:
+            run_forced_alignment(input_path, expected_text, output_path=output_path, language=args.lang, metrics=metrics,
+                                 output_format=args.format)
+            if metrics is not None:
+                write_metrics(metrics, args.metrics or default_metrics_path(output_path))
+            sys.exit(0)
+        run_whisperx(input_path, output_path=output_path, model_size=args.model, language=args.lang, compute_type=args.compute_type, use_cache=not args.no_cache, metrics=metrics,
+                     align=False if args.no_align else None, word_timings=args.word_timings, skip_align_below=args.skip_align_below,
+                     escalation_model=args.cascade, threads=args.threads, output_format=args.format)
+        if metrics is not None:
+            write_metrics(metrics, args.metrics or default_metrics_path(output_path))
         sys.exit(0)
     except Exception as e:
         print("[whisperx] Error during transcription: - transcribe_whisperx.py:116", file=sys.stderr)
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+"""
+Scheduler cho transcription: giữ N worker `transcribe_whisperx.py serve` luôn warm (model đã load),
+nhận job qua stdin (JSON lines) hoặc Unix socket và xếp vào hàng đợi ưu tiên có giới hạn.
+
+- Số worker mặc định tính theo số cores (thread profile / WHISPERX_THREADS) và RAM còn trống
+- Job "interactive" (clip của học viên) luôn được chạy trước job "batch" (re-scoring)
+- Hàng đợi đầy: trả về {"ok": false, "error": "queue_full", "retry_after": giây} thay vì chạy thêm process;
+  job interactive đẩy job batch mới nhất ra khỏi hàng đợi (job đó nhận queue_full), chỉ bị từ chối khi hàng đợi toàn interactive
+- {"op": "stats"}: queue depth, số worker bận, thời gian chờ trong hàng đợi
+
+Usage:
+    python transcription_scheduler.py [--socket /tmp/whisperx-scheduler.sock] [--workers N] [--queue-max 32]
+"""
+import os
+import sys
+import json
+import time
+import heapq
+import argparse
+import threading
+import subprocess
+import traceback
+from collections import deque
+
+# Ensure stdout/stderr use UTF-8 (prevents UnicodeEncodeError on Windows)
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+    sys.stderr.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "transcribe_whisperx.py")
+PRIORITIES = {"interactive": 0, "batch": 1}
+DEFAULT_PRIORITY = "interactive"
+QUEUE_MAX = int(os.getenv("WHISPERX_QUEUE_MAX", "32"))
+# RAM ước tính cho một worker (model base + align model + buffers)
+WORKER_MEMORY_MB = float(os.getenv("WHISPERX_WORKER_MEMORY_MB", "2048"))
+THREAD_PROFILE_PATH = os.getenv("WHISPERX_THREAD_PROFILE", os.path.join("outputs", ".thread_profile.json"))
+DEFAULT_WORKER_THREADS = 4  # whisperx.load_model(threads=4) khi không có profile
+STATS_WINDOW = 200  # số job gần nhất dùng cho thống kê wait time / thời gian chạy
+
+def log(message):
+    print(f"[scheduler] {message}", file=sys.stderr, flush=True)
+
+def available_memory_mb():
+    """MemAvailable từ /proc/meminfo (MB), None nếu không đọc được (không phải Linux)."""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def threads_per_worker():
+    """Threads của mỗi worker: WHISPERX_THREADS, hoặc cpu_threads trong profile của tune-threads."""
+    budget = int(os.getenv("WHISPERX_THREADS", "0"))
+    if budget:
+        return budget
+    try:
+        with open(THREAD_PROFILE_PATH, "r", encoding="utf-8") as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if profile.get("cpu_count") != os.cpu_count():
+        return None
+    return profile.get("cpu_threads")
+
+def default_worker_count(threads=None):
+    """min(cores / threads mỗi worker, RAM còn trống / WORKER_MEMORY_MB), tối thiểu 1."""
+    cores = os.cpu_count() or 1
+    by_cpu = max(1, cores // (threads or DEFAULT_WORKER_THREADS))
+    memory_mb = available_memory_mb()
+    by_memory = max(1, int(memory_mb // WORKER_MEMORY_MB)) if memory_mb else by_cpu
+    return min(by_cpu, by_memory)
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class QueueFull(Exception):
+    def __init__(self, retry_after):
+        super().__init__("queue_full")
+        self.retry_after = retry_after
+
+class Job:
+    def __init__(self, payload, priority, rank):
+        self.payload = payload
+        self.priority = priority
+        self.rank = rank
+        self.submitted = time.perf_counter()
+        self.started = None
+        self.depth_at_submit = 0
+        self.response = None
+        self.done = threading.Event()
+
+class Worker(threading.Thread):
+    """Một process `transcribe_whisperx.py serve` (stdin mode), chạy lần lượt các job lấy từ hàng đợi."""
+
+    def __init__(self, scheduler, index):
+        super().__init__(name=f"whisperx-worker-{index}", daemon=True)
+        self.scheduler = scheduler
+        self.index = index
+        self.proc = None
+
+    def _spawn(self):
+        cmd = [sys.executable, "-u", WORKER_SCRIPT, "serve", *self.scheduler.worker_args]
+        env = {**os.environ, "PYTHONIOENCODING": "utf-8", "PYTHONUTF8": "1"}
+        # stderr của worker (log whisperx) đi thẳng ra stderr của scheduler
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+                                     encoding="utf-8", bufsize=1, env=env)
+        ready = self.proc.stdout.readline()
+        try:
+            event = json.loads(ready)
+        except ValueError:
+            event = {}
+        if event.get("event") != "ready":
+            self._stop_process()
+            raise RuntimeError(f"worker {self.index} did not start (got: {ready.strip()!r})")
+        log(f"Worker {self.index} ready (pid {self.proc.pid}) - transcription_scheduler.py:126")
+
+    def _stop_process(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=10)
+        except Exception:
+            self.proc.kill()
+        self.proc = None
+
+    def run(self):
+        try:
+            self._spawn()
+        except Exception as e:
+            # Thử lại khi có job đầu tiên
+            log(f"⚠️  Worker {self.index} failed to start: {e} - transcription_scheduler.py:142")
+        while True:
+            job = self.scheduler.next_job()
+            if job is None:
+                break
+            try:
+                if self.proc is None or self.proc.poll() is not None:
+                    self._spawn()
+                self.proc.stdin.write(json.dumps(job.payload, ensure_ascii=False) + "\n")
+                self.proc.stdin.flush()
+                line = self.proc.stdout.readline()
+                if not line:
+                    raise RuntimeError("worker process exited")
+                response = json.loads(line)
+            except Exception as e:
+                traceback.print_exc(file=sys.stderr)
+                response = {"id": job.payload.get("id"), "ok": False, "error": f"worker {self.index} failed: {e}"}
+                # Process có thể đang ở trạng thái lỗi: bỏ đi, job sau sẽ spawn lại
+                if self.proc is not None:
+                    self.proc.kill()
+                    self.proc = None
+            self.scheduler.finish(job, response, self.index)
+        self._stop_process()
+
+class TranscriptionScheduler:
+    def __init__(self, workers, queue_max=QUEUE_MAX, worker_args=None):
+        self.queue_max = queue_max
+        self.worker_args = list(worker_args or [])
+        self._heap = []
+        self._seq = 0
+        self._busy = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._waits = deque(maxlen=STATS_WINDOW)
+        self._durations = deque(maxlen=STATS_WINDOW)
+        self.counters = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0}
+        self._workers = [Worker(self, i) for i in range(max(1, workers))]
+
+    def start(self):
+        # Các worker load model song song; số process tối đa = số worker, không phụ thuộc lượng job
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, payload):
+        """Đưa job vào hàng đợi, raise QueueFull(retry_after) nếu đầy."""
+        priority = payload.get("priority", DEFAULT_PRIORITY)
+        rank = PRIORITIES.get(priority)
+        if rank is None:
+            raise ValueError(f"Unknown priority: {priority!r} (expected one of {sorted(PRIORITIES)})")
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("scheduler is shutting down")
+            if len(self._heap) >= self.queue_max:
+                # Hàng đợi đầy: job interactive đẩy job batch mới nhất ra, batch bị từ chối trước
+                if rank == PRIORITIES["batch"] or not self._evict_newest_batch():
+                    self.counters["rejected"] += 1
+                    raise QueueFull(self._retry_after())
+            job = Job(payload, priority, rank)
+            # seq giữ thứ tự FIFO trong cùng mức ưu tiên
+            heapq.heappush(self._heap, (rank, self._seq, job))
+            self._seq += 1
+            job.depth_at_submit = len(self._heap)
+            self.counters["submitted"] += 1
+            self._cond.notify()
+        return job
+
+    def _evict_newest_batch(self):
+        # Gọi khi đang giữ _cond: bỏ job batch vào hàng đợi gần nhất, trả queue_full cho nó
+        batch = [entry for entry in self._heap if entry[0] == PRIORITIES["batch"]]
+        if not batch:
+            return False
+        entry = max(batch, key=lambda item: item[1])
+        self._heap.remove(entry)
+        heapq.heapify(self._heap)
+        self.counters["rejected"] += 1
+        job = entry[2]
+        job.response = {"id": job.payload.get("id"), "ok": False, "error": "queue_full",
+                        "retry_after": self._retry_after()}
+        job.done.set()
+        return True
+
+    def next_job(self):
+        with self._cond:
+            while not self._heap and not self._closed:
+                self._cond.wait()
+            if not self._heap:
+                return None
+            _, _, job = heapq.heappop(self._heap)
+            job.started = time.perf_counter()
+            self._waits.append(job.started - job.submitted)
+            self._busy += 1
+            return job
+
+    def finish(self, job, response, worker_index):
+        finished = time.perf_counter()
+        response["queue"] = {
+            "priority": job.priority,
+            "wait_seconds": round(job.started - job.submitted, 4),
+            "run_seconds": round(finished - job.started, 4),
+            "depth_at_submit": job.depth_at_submit,
+            "worker": worker_index,
+        }
+        with self._cond:
+            self._busy -= 1
+            self._durations.append(finished - job.started)
+            self.counters["completed" if response.get("ok") else "failed"] += 1
+        job.response = response
+        job.done.set()
+
+    def _retry_after(self):
+        # Gọi khi đang giữ _cond: ước lượng thời gian tới khi một chỗ trong hàng đợi được giải phóng
+        avg = sum(self._durations) / len(self._durations) if self._durations else 5.0
+        return round(max(1.0, avg / len(self._workers)), 1)
+
+    def stats(self):
+        with self._cond:
+            by_priority = {name: 0 for name in PRIORITIES}
+            for rank, _, job in self._heap:
+                by_priority[job.priority] += 1
+            waits = list(self._waits)
+            durations = list(self._durations)
+            return {
+                "workers": len(self._workers),
+                "busy": self._busy,
+                "queue_depth": len(self._heap),
+                "queue_max": self.queue_max,
+                "queue_by_priority": by_priority,
+                "wait_seconds": {
+                    "avg": round(sum(waits) / len(waits), 4) if waits else None,
+                    "p95": round(_percentile(waits, 0.95), 4) if waits else None,
+                    "max": round(max(waits), 4) if waits else None,
+                },
+                "avg_job_seconds": round(sum(durations) / len(durations), 4) if durations else None,
+                **self.counters,
+            }
+
+    def close(self, wait=True):
+        """Ngừng nhận job; các job đã vào hàng đợi vẫn được chạy hết."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+def dispatch(scheduler, line, write):
+    """Xử lý một dòng request; response được ghi bằng write(dict), có thể từ thread khác."""
+    try:
+        request = json.loads(line)
+    except ValueError as e:
+        write({"id": None, "ok": False, "error": f"Invalid JSON: {e}"})
+        return None
+    if not isinstance(request, dict):
+        write({"id": None, "ok": False, "error": "Request must be a JSON object"})
+        return None
+    if request.get("op") == "stats":
+        write({"id": request.get("id"), "ok": True, "stats": scheduler.stats()})
+        return None
+    try:
+        job = scheduler.submit(request)
+    except QueueFull as e:
+        write({"id": request.get("id"), "ok": False, "error": "queue_full", "retry_after": e.retry_after})
+        return None
+    except (ValueError, RuntimeError) as e:
+        write({"id": request.get("id"), "ok": False, "error": str(e)})
+        return None
+
+    def wait_and_reply():
+        job.done.wait()
+        write(job.response)
+
+    waiter = threading.Thread(target=wait_and_reply, daemon=True)
+    waiter.start()
+    return waiter
+
+def _serve_stdin(scheduler, out):
+    # Response có thể về không theo thứ tự gửi: caller ghép bằng "id"
+    out_lock = threading.Lock()
+
+    def write(response):
+        with out_lock:
+            out.write(json.dumps(response, ensure_ascii=False) + "\n")
+            out.flush()
+
+    waiters = []
+    for line in sys.stdin:
+        line = line.strip()
+        if line:
+            waiter = dispatch(scheduler, line, write)
+            if waiter is not None:
+                waiters.append(waiter)
+    # EOF: chạy hết các job đã nhận rồi mới thoát
+    for waiter in waiters:
+        waiter.join()
+
+def _serve_socket(scheduler, socket_path):
+    import socketserver
+
+    if not hasattr(socketserver, "UnixStreamServer"):
+        raise RuntimeError("Unix socket không được hỗ trợ trên hệ điều hành này, hãy dùng stdin mode")
+
+    class JobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            write_lock = threading.Lock()
+            waiters = []
+
+            def write(response):
+                with write_lock:
+                    try:
+                        self.wfile.write((json.dumps(response, ensure_ascii=False) + "\n").encode("utf-8"))
+                        self.wfile.flush()
+                    except OSError:
+                        pass  # client đã đóng kết nối
+
+            for raw in self.rfile:
+                line = raw.decode("utf-8").strip()
+                if line:
+                    waiter = dispatch(scheduler, line, write)
+                    if waiter is not None:
+                        waiters.append(waiter)
+            # Giữ connection tới khi các job của client này trả kết quả
+            for waiter in waiters:
+                waiter.join()
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with Server(socket_path, JobHandler) as server:
+        log(f"Listening on {socket_path} - transcription_scheduler.py:351")
+        try:
+            server.serve_forever()
+        finally:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+
+def _report_stats(scheduler, interval):
+    while True:
+        time.sleep(interval)
+        stats = scheduler.stats()
+        log(f"queue={stats['queue_depth']}/{stats['queue_max']} busy={stats['busy']}/{stats['workers']} "
+            f"wait_avg={stats['wait_seconds']['avg']} wait_p95={stats['wait_seconds']['p95']} "
+            f"rejected={stats['rejected']} - transcription_scheduler.py:364")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a pool of warm WhisperX workers behind a bounded priority queue.")
+    parser.add_argument("--socket", default=None, help="Unix socket path. If omitted, read jobs from stdin as JSON lines.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: sized to cores and RAM)")
+    parser.add_argument("--queue-max", type=int, default=QUEUE_MAX, help=f"Max queued jobs before rejecting (env WHISPERX_QUEUE_MAX, default {QUEUE_MAX})")
+    parser.add_argument("--threads", type=int, default=None, help="Thread budget per worker (default: WHISPERX_THREADS or tuned profile)")
+    parser.add_argument("--model", "-m", default="base", help="Whisper model size preloaded in every worker")
+    parser.add_argument("--lang", "-l", default=None, help="Default language code for jobs without 'lang'")
+    parser.add_argument("--compute-type", default=None, help="Default compute type (auto-detect if omitted)")
+    parser.add_argument("--stats-interval", type=float, default=0, help="Log queue stats to stderr every N seconds (0 = off)")
+    args = parser.parse_args()
+
+    threads = args.threads or threads_per_worker()
+    workers = args.workers or default_worker_count(threads)
+    worker_args = ["--model", args.model]
+    if args.lang:
+        worker_args += ["--lang", args.lang]
+    if args.compute_type:
+        worker_args += ["--compute-type", args.compute_type]
+    if threads:
+        worker_args += ["--threads", str(threads)]
+
+    scheduler = TranscriptionScheduler(workers, queue_max=args.queue_max, worker_args=worker_args)
+    scheduler.start()
+    log(f"Started {workers} worker(s), threads/worker={threads or 'default'}, queue_max={args.queue_max} - transcription_scheduler.py:389")
+    if args.stats_interval > 0:
+        threading.Thread(target=_report_stats, args=(scheduler, args.stats_interval), daemon=True).start()
+
+    print(json.dumps({"event": "ready", "workers": workers, "queue_max": args.queue_max, "threads_per_worker": threads}), flush=True)
+    try:
+        if args.socket:
+            _serve_socket(scheduler, args.socket)
+        else:
+            _serve_stdin(scheduler, sys.stdout)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scheduler.close()
+    sys.exit(0)
+
+if __name__ == "__main__":
+    main()